@@ -0,0 +1,104 @@
+import os
+import time
+import shutil
+import hashlib
+
+
+class BackupStore():
+    """ Content-addressed store of image backups
+
+        Each distinct file is kept once, as objects/<2 hex>/<sha256>,
+        whichever images and folders it was backed up from; the versions
+        each image has are recorded by the caller (see MetadataStore backups)
+        An object is a hardlink to the file backed up where possible, so
+        backing up an original costs no data writes (the gallery replaces
+        files it edits rather than writing into them, which leaves the
+        hardlinked original intact)
+    """
+
+    objectsDir = 'objects'
+    hashChunk = 1024*1024
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.objectsFolder = os.path.join(folder, self.objectsDir)
+
+    def object_path(self, digest):
+        return os.path.join(self.objectsFolder, digest[:2], digest)
+
+    def has(self, digest):
+        return os.path.exists(self.object_path(digest))
+
+    @classmethod
+    def file_hash(cls, path):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(cls.hashChunk), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def put(self, path, known=None):
+        """ Back up the file at path
+            known is (digest, size, mtime) of a version already stored, eg
+            the image's latest; if path still has that size and mtime it is
+            referenced without being read
+            Return (digest, (size, mtime) of path, how): how is 'referenced'
+            if the store already had the content, else 'linked' or 'copied'
+        """
+
+        st = os.stat(path)
+        stat = (st.st_size, st.st_mtime_ns)
+        if known and tuple(known[1:]) == stat and self.has(known[0]):
+            return known[0], stat, 'referenced'
+        digest = self.file_hash(path)
+        objectPath = self.object_path(digest)
+        if os.path.exists(objectPath):
+            return digest, stat, 'referenced'
+        os.makedirs(os.path.dirname(objectPath), exist_ok=True)
+        tmpPath = f'{ objectPath }.{ os.getpid() }.tmp'
+        try:
+            os.link(path, tmpPath)
+            how = 'linked'
+        except OSError: # eg another filesystem
+            shutil.copy2(path, tmpPath)
+            how = 'copied'
+        os.replace(tmpPath, objectPath)
+        return digest, stat, how
+
+    def restore(self, digest, dest):
+        """ Write a copy of object digest to dest, replacing it
+            (a copy, so later edits to dest can't reach the object)
+        """
+
+        tmpPath = os.path.join(
+            os.path.dirname(dest) or '.', f'.{ os.path.basename(dest) }.restore.tmp'
+        )
+        shutil.copy2(self.object_path(digest), tmpPath)
+        os.replace(tmpPath, dest)
+
+    def objects(self):
+        """ Return dict {digest: size} of every stored object """
+
+        found = {}
+        for folder, _, names in os.walk(self.objectsFolder):
+            for name in names:
+                if not name.endswith('.tmp'):
+                    found[name] = os.stat(os.path.join(folder, name)).st_size
+        return found
+
+    def remove_stale_tmp(self, age=24*60*60):
+        """ Remove temp files older than age seconds, left by interrupted puts """
+
+        for folder, _, names in os.walk(self.objectsFolder):
+            for name in names:
+                path = os.path.join(folder, name)
+                if name.endswith('.tmp') and time.time() - os.stat(path).st_mtime > age:
+                    os.remove(path)
+
+    def remove(self, digest):
+        path = self.object_path(digest)
+        try:
+            os.remove(path)
+            os.rmdir(os.path.dirname(path)) # if that was its last object
+        except OSError:
+            pass
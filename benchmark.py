@@ -0,0 +1,258 @@
+""" Benchmark the gallery's hot paths on a synthetic gallery
+
+    python benchmark.py --images 200 --workers 1,2,4 --output results.json
+    python benchmark.py --baseline results.json --threshold 0.25
+
+Results are written as JSON; with --baseline, timings more than threshold
+slower than the baseline are reported and the exit status is 1
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+from PIL import Image
+
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, REPO_DIR)
+import utils
+
+
+def make_gallery(folder, numImages, formats=('jpg',), resolutions=((1920, 1080),), seed=0):
+    """ Fill folder with numImages synthetic photos, cycling through
+        formats and resolutions; Return list of filenames
+    """
+
+    os.makedirs(folder, exist_ok=True)
+    rng = random.Random(seed)
+    names = []
+    for i in range(numImages):
+        fmt = formats[i % len(formats)]
+        size = resolutions[i % len(resolutions)]
+        # Smooth random content: upscaled noise compresses like a photo
+        noise = Image.effect_noise((32, 32), 64 + rng.randrange(64))
+        channels = [
+            noise.rotate(90*c).resize(size, Image.BICUBIC) for c in range(3)
+        ]
+        im = Image.merge('RGB', channels)
+        name = f'img_{ i:06d}.{ fmt }'
+        if fmt in ('jpg', 'jpeg'):
+            im.save(os.path.join(folder, name), quality=90)
+        else:
+            im.save(os.path.join(folder, name))
+        names.append(name)
+    return names
+
+def clone_gallery(src, dst):
+    """ Make dst a copy of gallery src, hardlinking where possible """
+
+    os.makedirs(dst, exist_ok=True)
+    for name in os.listdir(src):
+        try:
+            os.link(os.path.join(src, name), os.path.join(dst, name))
+        except OSError:
+            shutil.copy2(os.path.join(src, name), os.path.join(dst, name))
+
+def timed(func, *args, repeat=1, **kwargs):
+    """ Return best time of repeat calls to func, in seconds """
+
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+class Benchmark():
+    """ Time the hot paths on a synthetic gallery in a scratch directory
+        (FolderData keeps its metadata relative to the working directory)
+    """
+
+    def __init__(self, workDir, numImages, formats, resolutions, workerCounts):
+        self.workDir = workDir
+        self.numImages = numImages
+        self.formats = formats
+        self.resolutions = resolutions
+        self.workerCounts = workerCounts
+        self.galleryDir = os.path.join(workDir, 'gallery')
+        self.results = {}
+
+    def record(self, name, seconds, count=None):
+        result = {'seconds': seconds}
+        if count:
+            result['count'] = count
+            result['perItem'] = seconds/count
+        self.results[name] = result
+        print(f'{ name:50s} { seconds:9.4f}s' + (f'  ({ count } items)' if count else ''))
+
+    def run(self):
+        start = time.perf_counter()
+        make_gallery(self.galleryDir, self.numImages, self.formats, self.resolutions)
+        print(f'Generated { self.numImages } images in { time.perf_counter() - start:.1f}s')
+        os.chdir(self.workDir)
+        self.bench_list_images()
+        self.bench_thumbnails()
+        self.bench_make_thumbnails()
+        self.bench_folder_data()
+        self.bench_gallery_layout()
+        return self.results
+
+    def bench_list_images(self):
+        self.record(
+            'list_images.cold',
+            timed(utils.image_stats, self.galleryDir, refresh=True, repeat=3),
+            self.numImages,
+        )
+        utils.image_stats(self.galleryDir)
+        self.record(
+            'list_images.warm', timed(utils.list_images, self.galleryDir, repeat=20),
+        )
+
+    def bench_thumbnails(self):
+        dest = os.path.join(self.workDir, 'thumbs_single')
+        os.makedirs(dest, exist_ok=True)
+        images = utils.list_images(self.galleryDir)[:max(1, min(20, self.numImages))]
+        seconds = timed(lambda: [
+            utils.thumbnails((os.path.join(self.galleryDir, img), dest))
+            for img in images
+        ])
+        self.record('thumbnails', seconds, len(images))
+
+    def bench_make_thumbnails(self):
+        for numWorkers in self.workerCounts:
+            dest = os.path.join(self.workDir, f'thumbs_{ numWorkers }')
+            shutil.rmtree(dest, ignore_errors=True)
+            seconds = timed(
+                utils.make_thumbnails, self.galleryDir, dest, numWorkers=numWorkers
+            )
+            self.record(f'make_thumbnails.workers_{ numWorkers }', seconds, self.numImages)
+
+    def bench_folder_data(self):
+        from gallery import FolderData
+        folderData = FolderData()
+        settings = {'thumbSize': 'S'}
+        self.record('FolderData.open_folder', timed(
+            folderData.open_folder, self.galleryDir, settings, None
+        ), self.numImages)
+        for sortBy in ('rating', 'name', 'captured', 'similar', 'sharpness'):
+            self.record(f'FolderData.sorted_thumbs_names.{ sortBy }', timed(
+                folderData.sorted_thumbs_names, sortBy, repeat=5
+            ), self.numImages)
+        # Save cost as the metadata grows by gallery-sized folders
+        for numFolders in (1, 10, 50):
+            while len(folderData.allFolderData) < numFolders + 1:
+                copyDir = f'{ self.galleryDir }_copy{ len(folderData.allFolderData) }'
+                clone_gallery(self.galleryDir, copyDir)
+                folderData.new_folder_data(copyDir)
+            for img in folderData.images()[:50]:
+                folderData.set_rating(img, random.randrange(4))
+            self.record(
+                f'FolderData.update_save_folder_data.folders_{ numFolders }',
+                timed(folderData.update_save_folder_data),
+            )
+
+    def bench_gallery_layout(self):
+        from gallery import WindowManager
+        # Construct elements only; no window (and no display) is needed
+        WindowManager.screenWidth, WindowManager.screenHeight = 1920, 1080
+        wm = WindowManager()
+        wm.folder = wm.folderData.open_folder(self.galleryDir, wm.folderSettings, wm)
+        self.record(
+            'WindowManager.gallery_layout', timed(wm.gallery_layout, repeat=3), self.numImages,
+        )
+
+
+def compare(results, baseline, threshold, minSeconds=0.001):
+    """ Print timings against baseline; Return names of regressions
+        (timings under minSeconds are too noisy to flag)
+    """
+
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old, new = baseline[name]['seconds'], result['seconds']
+        ratio = new/old if old else float('inf')
+        flag = ''
+        if ratio > 1 + threshold and new >= minSeconds:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f'{ name:50s} { old:9.4f}s -> { new:9.4f}s  x{ ratio:.2f}{ flag }')
+    return regressions
+
+def parse_resolutions(text):
+    return [tuple(int(n) for n in r.split('x')) for r in text.split(',')]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark gallery hot paths')
+    parser.add_argument('--images', type=int, default=100, help='synthetic gallery size')
+    parser.add_argument('--formats', default='jpg,png', help='eg jpg,png')
+    parser.add_argument(
+        '--resolutions', default='4000x3000,1920x1080', help='eg 6000x4000,1920x1080',
+    )
+    parser.add_argument(
+        '--workers', default=f'1,{ os.cpu_count() or 1 }', help='worker counts, eg 1,2,4,8',
+    )
+    parser.add_argument('--output', default=None, help='write results JSON here')
+    parser.add_argument('--baseline', default=None, help='results JSON to compare with')
+    parser.add_argument(
+        '--threshold', type=float, default=0.25, help='allowed slowdown vs baseline (0.25 = 25%%)',
+    )
+    parser.add_argument(
+        '--min-seconds', type=float, default=0.001, help='ignore regressions in faster timings',
+    )
+    parser.add_argument('--keep', action='store_true', help='keep the scratch directory')
+    args = parser.parse_args(argv)
+
+    workDir = tempfile.mkdtemp(prefix='gallery_bench_')
+    cwd = os.getcwd()
+    try:
+        results = Benchmark(
+            workDir = workDir,
+            numImages = args.images,
+            formats = args.formats.split(','),
+            resolutions = parse_resolutions(args.resolutions),
+            workerCounts = sorted({int(w) for w in args.workers.split(',')}),
+        ).run()
+    finally:
+        os.chdir(cwd)
+        if args.keep:
+            print('Scratch directory:', workDir)
+        else:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'images': args.images,
+            'formats': args.formats,
+            'resolutions': args.resolutions,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold, args.min_seconds)
+        if regressions:
+            print(f'{ len(regressions) } regressions over { args.threshold:.0%}')
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,24 +1,45 @@
 import os
-import shutil
-import json
+import argparse
 import uuid
 import time
 import queue
+import heapq
 from collections import namedtuple
 import threading
 mutex = threading.Lock()
 import concurrent.futures
-from multiprocessing import Pool, Queue
+from collections import OrderedDict
 import PySimpleGUI as sg
-from PIL import Image
 from utils import *
+from thumbindex import ThumbIndex, FRESH, MISSING
+from thumbengine import ThumbEngine
+from metadata import MetadataStore
+from watcher import FolderWatcher, ADDED, REMOVED, MODIFIED
+from thumbcache import ThumbCache
+from thumbpack import ThumbPack
+from backupstore import BackupStore
+from simindex import group_similar
+from sortindex import *
+from perfstats import perfStats
+import quality
 
 sg.theme('Dark Blue')
 sg.SetOptions(window_location=(-6,0))
 
 
-ImageUpdateRecord = namedtuple('ImageUpdateRecord', 'image, folder')
+THUMB = 'thumb'
+PROGRESS = 'progress'
+COPY_DONE = 'copy_done'
+RESTORE_DONE = 'restore_done'
+REPORT_KINDS = (PROGRESS, COPY_DONE, RESTORE_DONE) # shown whichever folder is open
+PREVIEW = 'preview'
+SORT_SIMILAR = 'similar'
+ORIGINAL_VERSION = 1 # an image's first backup version is its original
+ImageUpdateRecord = namedtuple(
+    'ImageUpdateRecord', 'image, folder, kind, data', defaults=(THUMB, None)
+)
 ImageKey = namedtuple('ImageKey', 'image, element')
+CellKey = namedtuple('CellKey', 'cell, element')
 
 
 class FolderData():
@@ -27,32 +48,92 @@ class FolderData():
     thumbsSubDir = '.t'
     backupsSubDir = '.b'
     allFolderDataPath = os.path.join('.metadata', 'all_folder_data.json')
+    metadataDbPath = os.path.join('.metadata', 'metadata.db')
+    backupStorePath = os.path.join('.metadata', 'backups')
     allFolderData = None
+    store = None
+    backupStore = None
+    similarDistance = 6 # max dhash bits apart for "similar" grouping
+    thumbPacks = False # keep thumbs of newly opened folders in a ThumbPack
 
     def __init__(self):
         self.openFolderPath = None
         self.openFolderData = None
         self.settings = None
+        self.thumbIndex = None
+        self.thumbPack = None
+        self.sortIndex = None
         if self.allFolderData is None:
             self.load_all_data()
 
     def load_all_data(self):
-        try:
-            with open(self.allFolderDataPath, encoding='utf-8') as file:
-                self.allFolderData = json.load(file)
-        except FileNotFoundError:
-            self.allFolderData = {}
+        """ Load metadata store and its folder registry, importing legacy
+            all_folder_data.json once; image metadata is loaded per folder
+            as folders are opened
+        """
+
+        FolderData.store = MetadataStore(self.metadataDbPath)
+        FolderData.backupStore = BackupStore(self.backupStorePath)
+        if self.store.migrate_json(self.allFolderDataPath):
+            print('Migrated folder data from', self.allFolderDataPath)
+        FolderData.allFolderData = self.store.load_folders()
 
     def open_folder(self, folderPath, settings, windowManager):
         self.openFolderPath = folderPath
         self.settings = settings
+        stats = image_stats(folderPath, refresh=True) # pick up edits made while closed
         self.openFolderData = self.get_folder_data(self.openFolderPath)
+        self.sortIndex = SortIndex({})
+        for img in stats:
+            self.add_image(img, stats)
+        self.thumbIndex = ThumbIndex(
+            self.openFolderPath, self.openFolderData['thumbnailFolder']
+        )
+        self.open_thumb_pack()
         return True
 
+    def open_thumb_pack(self):
+        """ Use the open folder's thumb pack if it has one, or start one if
+            thumbPacks is set, moving fresh thumb files into it
+        """
+
+        if self.thumbPack:
+            self.thumbPack.close()
+            self.thumbPack = None
+        thumbnailFolder = self.openFolderData['thumbnailFolder']
+        packFolder = os.path.dirname(thumbnailFolder)
+        if not (self.thumbPacks or os.path.exists(os.path.join(packFolder, ThumbPack.dataName))):
+            return
+        self.thumbPack = ThumbPack(packFolder)
+        stats = image_stats(self.openFolderPath)
+        fresh = {}
+        for thumbSize in THUMBNAIL_SIZES:
+            for img, status in self.thumbIndex.classify(stats, thumbSize).items():
+                if status == FRESH and not self.thumbPack.has(thumbSize, img, stats[img]):
+                    fresh[(thumbSize, img)] = stats[img]
+        if fresh:
+            print('Moved', self.thumbPack.import_files(thumbnailFolder, fresh), 'thumbs into pack')
+        self.thumbPack.compact_if_due()
+
+    def thumb_status(self, stats, thumbSize):
+        """ Return dict {img: FRESH or MISSING/STALE} for images in stats
+            (see ThumbIndex.classify)
+        """
+
+        if self.thumbPack is None:
+            return self.thumbIndex.classify(stats, thumbSize)
+        return {
+            img: FRESH if self.thumbPack.has(thumbSize, img, stat) else MISSING
+            for img, stat in stats.items()
+        }
+
     def get_folder_data(self, folderPath):
-        if folderPath in self.allFolderData:
-            return self.allFolderData[folderPath]
-        return self.new_folder_data(folderPath)
+        folderData = self.allFolderData.get(folderPath)
+        if folderData is None:
+            return self.new_folder_data(folderPath)
+        if 'imageData' not in folderData:
+            folderData['imageData'] = self.store.load_images(folderData['uid'])
+        return folderData
     
     def new_folder_data(self, folderPath):
         new_uid = str(uuid.uuid4())
@@ -67,10 +148,10 @@ class FolderData():
                     for img in list_images(folderPath)
                 },
         }
-        # Make new dirs
+        # Make new dirs (backupsFolder is only read, to import backups made
+        # before the backup store; see import_legacy_backups)
         for newMetadataSubdir in (
                 folderData['thumbnailFolder'], 
-                folderData['backupsFolder'],
             ):
             try: 
                 os.makedirs(newMetadataSubdir, exist_ok=False)
@@ -85,26 +166,147 @@ class FolderData():
             f"{ self.settings['thumbSize'] }_{ os.path.splitext(img)[0] }.png",
         )
 
-    def backup_path(self, img):
-        return os.path.join(self.openFolderData['backupsFolder'], img)
+    @staticmethod
+    def read_thumb(thumbPack, thumbnailFolder, img, thumbSize, stat=None):
+        """ Return PNG bytes of img's thumb from thumbPack, if given, else
+            from its file in thumbnailFolder; Return None if there is none
+            (or, in a pack, none made from source stat)
+        """
+
+        if thumbPack is not None:
+            return thumbPack.get(thumbSize, img, stat)
+        try:
+            with open(os.path.join(
+                    thumbnailFolder, f'{ thumbSize }_{ os.path.splitext(img)[0] }.png'), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def thumb_bytes(self, img, stat=None):
+        """ Pack-aware thumb_path: Return bytes of img's thumb, or None """
+
+        return self.read_thumb(
+            self.thumbPack, self.openFolderData['thumbnailFolder'], img,
+            self.settings['thumbSize'], stat,
+        )
+
+    def import_legacy_backups(self, folderPath):
+        """ Move backups made before versioning (one file per image in the
+            folder's backupsFolder, overwritten by each resize) into the
+            backup store as each image's first version; Return number moved
+        """
+
+        folderData = self.allFolderData[folderPath]
+        backupsFolder = folderData['backupsFolder']
+        try:
+            names = sorted(os.listdir(backupsFolder))
+        except FileNotFoundError:
+            return 0
+        imported = 0
+        for name in names:
+            path = os.path.join(backupsFolder, name)
+            if name.endswith('.tmp') or not os.path.isfile(path):
+                continue
+            digest, stat, _ = self.backupStore.put(path)
+            self.store.add_backup(folderData['uid'], name, digest, stat, os.stat(path).st_mtime)
+            os.remove(path)
+            imported += 1
+        return imported
+
+    def backup_versions(self, folderPath, img):
+        """ Return backup rows of img, oldest (the original) first """
+
+        return self.store.backups(self.allFolderData[folderPath]['uid'], img)
+
+    def known_backup(self, folderPath, img):
+        """ Return (digest, size, mtime) of img's latest backup, or None
+            (see BackupStore.put)
+        """
+
+        versions = self.backup_versions(folderPath, img)
+        if not versions:
+            return None
+        return versions[-1]['hash'], versions[-1]['size'], versions[-1]['mtime']
+
+    def record_backup(self, folderPath, img, digest, stat):
+        """ Record a backup of img at stat (size, mtime) stored under digest,
+            unless it is the same as the latest; Return its version
+        """
+
+        versions = self.backup_versions(folderPath, img)
+        if versions and versions[-1]['hash'] == digest:
+            return versions[-1]['version']
+        return self.store.add_backup(
+            self.allFolderData[folderPath]['uid'], img, digest, stat, time.time()
+        )
+
+    def backup_image(self, folderPath, img):
+        """ Back up img as it is now, before it is replaced; Return its
+            version (the latest, if unchanged since that was stored)
+        """
+
+        with perfStats.timer('resize.backup'):
+            digest, stat, how = self.backupStore.put(
+                os.path.join(folderPath, img), self.known_backup(folderPath, img)
+            )
+        perfStats.incr(f'backup.{ how }')
+        return self.record_backup(folderPath, img, digest, stat)
+
+    def restore_image(self, folderPath, img, version=None):
+        """ Replace img with a backed up version (default: the oldest kept,
+            the original unless backups gc dropped it); the current file is
+            backed up first, so a restore can be undone
+            Return (version restored, (size, mtime) of the restored file);
+            Raise KeyError if img has no such version
+        """
+
+        versions = self.backup_versions(folderPath, img)
+        if version is None and versions:
+            row = versions[0]
+        else:
+            row = next((r for r in versions if r['version'] == version), None)
+        if row is None:
+            raise KeyError(f'{ img } has no backup version { version or "" }'.strip())
+        path = os.path.join(folderPath, img)
+        if os.path.exists(path):
+            digest, stat, _ = self.backupStore.put(path, self.known_backup(folderPath, img))
+            if digest == row['hash']:
+                return row['version'], stat
+            self.record_backup(folderPath, img, digest, stat)
+        self.backupStore.restore(row['hash'], path)
+        st = os.stat(path)
+        return row['version'], (st.st_size, st.st_mtime_ns)
 
     def update_save_folder_data(self, fpath=None, fdata=None):
-        """ If fpath, fdata are None, update open folder entry """
+        """ Save new folder entry fpath, fdata;
+            If fpath, fdata are None, write pending open folder changes
+        """
 
         if fpath and fdata:
             self.allFolderData[fpath] = fdata
+            self.store.save_folder(fdata)
         elif not fpath and not fdata:
-            self.allFolderData[self.openFolderPath] = self.openFolderData
+            self.store.flush()
         else:
             raise ValueError('Cannot specify one of fpath, fdata without the other')
-        with open(self.allFolderDataPath, 'w', encoding='utf-8') as f:
-            json.dump(self.allFolderData, f)
+
+    def flush_if_due(self):
+        self.store.flush_if_due()
 
     def new_image_data(self, img):
         return {
             'path': img,
             'name': os.path.basename(img),
             'rating': -1,
+            'dhash': None,
+            'width': None,
+            'height': None,
+            'captureTime': None,
+            'sharpness': None,
+            'brightness': None,
+            'clipped': None,
+            'contrast': None,
+            'infoMtime': None,
         }
 
     @property
@@ -125,8 +327,100 @@ class FolderData():
     def images(self):
         return list_images(self.openFolderPath)
 
+    def add_image(self, img, stats=None):
+        """ Add metadata for an image that appeared after the folder was made,
+            or refresh the sort attributes of one that changed
+            (stats: the folder's image_stats, if the caller has them)
+        """
+
+        imageData = self.openFolderData['imageData']
+        if img not in imageData:
+            imageData[img] = self.new_image_data(img)
+            self.store.update_image(self.openFolderData['uid'], img, path=img)
+        if stats is None:
+            stats = image_stats(self.openFolderPath)
+        stat = stats.get(img)
+        if stat is None:
+            return
+        attrs = {
+            k: imageData[img].get(k)
+            for k in ('rating', 'width', 'height', 'captureTime') + quality.METRICS
+        }
+        self.sortIndex.update(img, size=stat[0], mtime=stat[1], **attrs)
+
+    def remove_image(self, img):
+        """ Forget thumbnails for a removed image (its rating is kept,
+            in case it comes back)
+        """
+
+        self.thumbIndex.forget(img)
+        if self.thumbPack:
+            self.thumbPack.forget(img)
+        self.sortIndex.remove(img)
+
     def set_rating(self, image, rating):
         self.openFolderData['imageData'][image]['rating'] = rating
+        self.store.update_image(self.openFolderData['uid'], image, rating=rating)
+        self.sortIndex.update(image, rating=rating)
+
+    def set_image_info(self, folderPath, img, stat, info):
+        """ Store attributes read from img as it was at stat (size, mtime):
+            dhash, width, height, captureTime and quality metrics
+            (see utils.thumbnails)
+            (Called from thumbnail threads; folderPath need not be open)
+        """
+
+        folderData = self.allFolderData[folderPath]
+        imageData = folderData['imageData'].setdefault(img, self.new_image_data(img))
+        imageData.update(info, infoMtime=stat[1])
+        self.store.update_image(folderData['uid'], img, infoMtime=stat[1], **info)
+        sortIndex = self.sortIndex
+        if folderPath == self.openFolderPath and sortIndex and img in sortIndex:
+            attrs = {k: v for k, v in info.items() if k != 'dhash'}
+            sortIndex.update(img, size=stat[0], mtime=stat[1], **attrs)
+
+    def images_without_info(self, folderPath, stats):
+        """ Return images in stats with no info read from their current version
+            (or, if quality metrics can be measured, none measured yet)
+        """
+
+        imageData = self.allFolderData[folderPath]['imageData']
+        measure = quality.available()
+        return [
+            img for img, stat in stats.items()
+            if imageData.get(img, {}).get('infoMtime') != stat[1]
+            or measure and imageData.get(img, {}).get('sharpness') is None
+        ]
+
+    def similar_order(self):
+        """ Return images in name order, except that images similar to an
+            earlier one are moved up to follow it
+            (Images not hashed yet are left in place)
+            Covers the images of the sort index, like the other orders: an
+            image the folder scan already sees is only included once its
+            ADDED change has been applied
+        """
+
+        names = self.sortIndex.order(SORT_NAME)
+        stats = image_stats(self.openFolderPath)
+        imageData = self.openFolderData['imageData']
+        hashes = {}
+        for img in names:
+            data, stat = imageData.get(img), stats.get(img)
+            if data and data['dhash'] and stat and data['infoMtime'] == stat[1]:
+                hashes[img] = int(data['dhash'], 16)
+        with perfStats.timer('sort.similar'):
+            groups = group_similar(hashes, self.similarDistance)
+        groupOf = {img: group for group in groups for img in group}
+        order = []
+        placed = set()
+        for img in names:
+            if img in placed:
+                continue
+            group = sorted(groupOf.get(img, (img,)))
+            order.extend(group)
+            placed.update(group)
+        return order
 
     def get_rating(self, image):
         return self.openFolderData['imageData'][image]['rating']
@@ -136,144 +430,946 @@ class FolderData():
 
         return {
             img: self.openFolderData['imageData'][img]['rating']
-            for img in list_images(self.openFolderPath)
+            for img in self.images()
         }
 
-    def sorted_thumbs_names(self, sortByRating):
-        """ Return (thumbs, names) optional sorted by rating """
+    def sorted_thumbs_names(self, sortBy=SORT_NAME):
+        """ Return (thumbs, names) sorted by similarity or any SORT_KEYS key
+            (ties in name order)
+        """
 
-        if sortByRating:
-            thumbs = self.thumbnail_paths()
-            imgRatingDict = self.image_ratings()
-            sortedTriples = sorted(
-                list(zip(thumbs, imgRatingDict.keys(), imgRatingDict.values())),
-                key = lambda x: -x[-1]
-            )
-            return list(zip(*sortedTriples))[:2] # magic unpacking
+        if sortBy == SORT_SIMILAR:
+            names = self.similar_order()
         else:
-            return (self.thumbnail_paths(), self.images())
+            names = self.sortIndex.order(sortBy)
+        return [self.thumb_path(img) for img in names], names
+
 
+class FolderThumbs():
+    """ What the thumb job manager needs to know about one opened folder
+        (snapshotted, so jobs still in flight after a folder switch finish
+        against the folder they were started for)
+    """
+
+    def __init__(self, folderData):
+        self.src = folderData.openFolderPath
+        self.dest = folderData.openFolderData['thumbnailFolder']
+        self.uid = folderData.openFolderData['uid']
+        self.thumbIndex = folderData.thumbIndex
+        self.thumbPack = folderData.thumbPack
+        self.stats = image_stats(self.src)
+        self.thumbSize = None # last size asked for
+        self.made = 0
+        self.infoRead = False
+
+    def is_fresh(self, img, thumbSize):
+        stat = self.stats.get(img)
+        if stat is None:
+            return False
+        if self.thumbPack:
+            return self.thumbPack.has(thumbSize, img, stat)
+        return self.thumbIndex.status(img, stat, thumbSize) == FRESH
+
+    def read_thumb(self, img, thumbSize):
+        return FolderData.read_thumb(
+            self.thumbPack, self.dest, img, thumbSize, self.stats.get(img)
+        )
 
-class ThreadedThumbApp(threading.Thread):
-    """ Retrieve thumbnails in a thread parallel to main window thread """
 
-    def __init__(self, windowManager, src, dest, images):
-        super().__init__()
+class ThumbJobManager(threading.Thread):
+    """ One long-lived thread getting thumbnails for the open folder
+        (missing thumbnails are made on the window manager's ThumbEngine)
+
+        Requests add (image, thumb size) work for the open folder; work
+        left over for a folder that is no longer open is dropped. Images are
+        taken nearest the page on screen first (see prioritize). Jobs in
+        flight are deduplicated by (folder, image): asking again for an
+        image being made, at any size, waits on that job; sizes the job
+        doesn't make are asked for again once it is done
+    """
+
+    saveEvery = 256
+    infoBatch = 32 # images per job when reading info of existing thumbs
+
+    def __init__(self, windowManager):
+        super().__init__(daemon=True)
         self._stop_event = threading.Event()
         self.wm = windowManager
-        self.src = src
-        self.dest = dest
-        self.images = images
+        self.cond = threading.Condition()
+        self.folder = None # FolderThumbs of the open folder
+        self.wanted = {} # {img: set of thumb sizes} still to do for self.folder
+        self.queue = [] # heap of (rank, img) over wanted
+        self.rank = {}
+        self.inFlight = {} # {(src, img, stat): set of thumb sizes waiting}
+        self.prefetchRanks = 0
+
+    def request(self, images, thumbSize):
+        """ Ask for thumbs of images of the open folder at thumbSize """
+
+        folderData = self.wm.folderData
+        with self.cond:
+            folder = self.folder
+            if (folder is None or folder.src != folderData.openFolderPath
+                    or folder.thumbIndex is not folderData.thumbIndex):
+                # Another folder (or the same one reopened): drop its work
+                perfStats.incr('thumbjobs.cancelled', len(self.wanted))
+                self.folder = FolderThumbs(folderData)
+                self.wanted = {}
+            else:
+                folder.stats = image_stats(folder.src)
+                folder.infoRead = False
+            self.folder.thumbSize = thumbSize
+            for img in images:
+                self.wanted.setdefault(img, set()).add(thumbSize)
+            self.requeue()
+            self.cond.notify()
+
+    def prioritize(self, order, pageStart, pageSize):
+        """ Rank images by distance from the page on screen in the gallery
+            order: that page first, then pages ahead before pages behind (2:1)
+            (Called again whenever the page or the order changes)
+        """
+
+        rank = {
+            img: pos - pageStart if pos >= pageStart else pageSize + 2*(pageStart - pos)
+            for pos, img in enumerate(order)
+        }
+        with self.cond:
+            self.rank = rank
+            # Fresh thumbs this close to the screen are read into the cache
+            self.prefetchRanks = 2*pageSize
+            self.requeue()
+
+    def requeue(self):
+        last = 2*len(self.rank)
+        self.queue = [(self.rank.get(img, last), img) for img in self.wanted]
+        heapq.heapify(self.queue)
+
+    def next_image(self):
+        """ Return (folder, rank, img, thumb sizes) of the nearest image
+            wanted, or None
+        """
+
+        with self.cond:
+            while self.queue:
+                rank, img = heapq.heappop(self.queue)
+                sizes = self.wanted.pop(img, None)
+                if sizes:
+                    return self.folder, rank, img, sizes
+        return None
 
     def run(self):
-        for img in self.images:
-            try: 
-                Image.open(self.wm.folderData.thumb_path(img))
-                print('Thumb exists:', img)
-            except:
-                thumbnails((os.path.join(self.src, img), self.dest))
-                print('Create thumb:', img)
-            record = ImageUpdateRecord(
-                image=img, folder=self.wm.folderData.openFolderPath
+        while not self._stop_event.is_set():
+            with self.cond:
+                while not self.wanted and (not self.folder or self.folder.infoRead):
+                    if self._stop_event.is_set():
+                        return
+                    self.cond.wait(timeout=1)
+                folder = self.folder
+            self.wm.thumbEngine.run(
+                jobs = self.jobs(),
+                onDone = self.thumb_done,
+                stopEvent = self._stop_event,
+                cost = thumbnail_cost,
+            )
+            with self.cond:
+                readInfo = not self.wanted and folder is self.folder
+                folders = {folder, self.folder} # the folder may have switched mid-run
+            for f in folders:
+                f.thumbIndex.save()
+            if readInfo:
+                self.read_fresh_info(folder)
+
+    def jobs(self):
+        """ Yield thumb jobs nearest first, as the engine has room for them;
+            fresh thumbs are reported on the way
+        """
+
+        while not self._stop_event.is_set():
+            item = self.next_image()
+            if item is None:
+                return
+            folder, rank, img, sizes = item
+            for thumbSize in [s for s in sizes if folder.is_fresh(img, s)]:
+                perfStats.incr('thumb.fresh')
+                sizes.discard(thumbSize)
+                if rank < self.prefetchRanks:
+                    self.prefetch(folder, img, thumbSize)
+                self.put_record(folder, img)
+            stat = folder.stats.get(img)
+            if not sizes or stat is None:
+                continue
+            with self.cond:
+                waiting = self.inFlight.get((folder.src, img, stat))
+                if waiting is not None:
+                    perfStats.incr('thumbjobs.deduped')
+                    waiting.update(sizes)
+                    continue
+                self.inFlight[(folder.src, img, stat)] = set(sizes)
+            # Only the sizes wanted; another size is made when switched to,
+            # from the nearest larger thumb if there is one
+            yield (folder, img, stat), (
+                os.path.join(folder.src, img), None if folder.thumbPack else folder.dest,
+                tuple(sizes), tuple(sizes), self.larger_thumb(folder, img, sizes),
             )
-            self.wm.put_image_update(record)
+
+    def larger_thumb(self, folder, img, sizes):
+        """ Return bytes of the smallest fresh thumb of img larger than all
+            of sizes, or None
+        """
+
+        largest = max(THUMBNAIL_SIZES[s] for s in sizes)
+        for thumbSize, size in reversed(THUMBNAIL_SIZE_ITEMS):
+            if size > largest and folder.is_fresh(img, thumbSize):
+                return folder.read_thumb(img, thumbSize)
+        return None
+
+    def read_fresh_info(self, folder):
+        """ Read sort attributes and hashes of images whose thumbs are fresh
+            but were made before these were recorded, from the image header
+            and the existing thumb (no full decode)
+        """
+
+        folder.infoRead = True
+        self.wm.thumbEngine.run(
+            jobs = self.info_jobs(folder),
+            onDone = self.info_done,
+            stopEvent = self._stop_event,
+            func = read_image_info,
+        )
+
+    def info_jobs(self, folder):
+        thumbSize = folder.thumbSize
+        images = self.wm.folderData.images_without_info(folder.src, folder.stats)
+        for batch in batches(images, self.infoBatch):
+            with self.cond:
+                if folder is not self.folder or self.wanted:
+                    return # thumbs come first; info is read again after them
+            pairs = []
+            for img in batch:
+                if folder.thumbPack:
+                    thumb = folder.thumbPack.get(thumbSize, img)
+                else:
+                    thumb = os.path.join(
+                        folder.dest, f'{ thumbSize }_{ os.path.splitext(img)[0] }.png'
+                    )
+                pairs.append((os.path.join(folder.src, img), thumb))
+            yield (folder, [(img, folder.stats[img]) for img in batch]), pairs
+
+    def info_done(self, key, result, error):
+        folder, batch = key
+        if not error:
+            for (img, stat), info in zip(batch, result):
+                if info:
+                    self.wm.folderData.set_image_info(folder.src, img, stat, info)
+
+    def thumb_done(self, key, result, error):
+        folder, img, stat = key
+        with self.cond:
+            sizes = self.inFlight.pop((folder.src, img, stat), ())
+        if error:
+            print('Failed to create thumb:', img, error)
+            return
+        perfStats.incr('thumb.made')
+        made, info = result
+        if folder.thumbPack:
+            for thumbSize, data in made.items():
+                folder.thumbPack.put(thumbSize, img, stat, data)
+        folder.thumbIndex.record(img, stat, made)
+        if info: # none if made from a larger thumb
+            self.wm.folderData.set_image_info(folder.src, img, stat, info)
+        for thumbSize in sizes:
+            if thumbSize not in made:
+                continue
+            data = made[thumbSize] or folder.read_thumb(img, thumbSize)
+            if data is not None:
+                self.wm.thumbCache.put(
+                    ThumbCache.make_key(folder.uid, img, thumbSize, stat), data
+                )
+        # Sizes asked for while this job was running at other sizes
+        self.request_again(folder, img, [s for s in sizes if s not in made])
+        folder.made += 1
+        if folder.made % self.saveEvery == 0:
+            folder.thumbIndex.save()
+        self.put_record(folder, img)
+
+    def request_again(self, folder, img, sizes):
+        with self.cond:
+            if not sizes or folder is not self.folder:
+                return
+            self.wanted.setdefault(img, set()).update(sizes)
+            heapq.heappush(self.queue, (self.rank.get(img, 2*len(self.rank)), img))
+            self.cond.notify()
+
+    def prefetch(self, folder, img, thumbSize):
+        """ Read an existing thumb into the cache off the GUI thread """
+
+        key = ThumbCache.make_key(folder.uid, img, thumbSize, folder.stats[img])
+        if key in self.wm.thumbCache:
+            return
+        data = folder.read_thumb(img, thumbSize)
+        if data is not None:
+            self.wm.thumbCache.put(key, data)
+
+    def put_record(self, folder, img):
+        self.wm.put_image_update(ImageUpdateRecord(image=img, folder=folder.src))
 
     def stop(self):
         self._stop_event.set()
+        with self.cond:
+            self.cond.notify()
+
+
+class PreviewLoader(threading.Thread):
+    """ Decode and downscale full images for the preview window on the
+        window manager's previewEngine, into its previewCache
+        (an engine of its own: on the thumbs' engine, previews would queue
+        behind a folder's thumb jobs and double its pixel budget)
+
+        Each request replaces the images wanted (the one shown, then its
+        neighbours in gallery order), so read-ahead for an earlier position
+        is dropped instead of delaying the new one
+    """
+
+    def __init__(self, windowManager):
+        super().__init__(daemon=True)
+        self._stop_event = threading.Event()
+        self.wm = windowManager
+        self.cond = threading.Condition()
+        self.wanted = [] # [((folder, cache key), (path, size))], nearest first
+        self.inFlight = set() # cache keys
+
+    def request(self, wanted):
+        with self.cond:
+            self.wanted = list(wanted)
+            self.cond.notify()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            with self.cond:
+                while not self.wanted:
+                    if self._stop_event.is_set():
+                        return
+                    self.cond.wait(timeout=1)
+            self.wm.previewEngine.run(
+                jobs = self.jobs(),
+                onDone = self.preview_done,
+                stopEvent = self._stop_event,
+                func = preview_image,
+                cost = preview_cost,
+            )
+
+    def jobs(self):
+        while True:
+            with self.cond:
+                if not self.wanted:
+                    return
+                (folder, key), args = self.wanted.pop(0)
+                if key in self.inFlight:
+                    continue
+                if key in self.wm.previewCache:
+                    perfStats.incr('preview.ready')
+                    continue
+                self.inFlight.add(key)
+            yield (folder, key), args
+
+    def preview_done(self, jobKey, result, error):
+        folder, key = jobKey
+        with self.cond:
+            self.inFlight.discard(key)
+        image = key[1]
+        if error:
+            print('Failed to preview:', image, error)
+            return
+        perfStats.incr('preview.made')
+        self.wm.previewCache.put(key, result)
+        self.wm.put_image_update(ImageUpdateRecord(image=image, folder=folder, kind=PREVIEW))
+
+    def stop(self):
+        self._stop_event.set()
+        with self.cond:
+            self.cond.notify()
 
 
 class ThreadedResizeApp(threading.Thread):
     """ Resize images in a thread parallel to main window thread 
         (Also, remake thumbnails for resized images)
+        Each image is backed up (as a new version in the backup store) in
+        this thread, and its version recorded, before it is resized and
+        re-thumbnailed with one decode on the window manager's resizeEngine,
+        so a resize cut short (eg by closing the window) can't leave a
+        replaced original that no version refers to
     """
 
-    def __init__(self, windowManager, folder, images, size, backupFolder, thumbFolder):
+    def __init__(self, windowManager, folder, images, size, thumbFolder):
         super().__init__()
         self._stop_event = threading.Event()
         self.wm = windowManager
         self.folder = folder
         self.images = images
         self.size = size
-        self.backupFolder = backupFolder
         self.thumbFolder = thumbFolder
+        self.thumbIndex = windowManager.folderData.thumbIndex
+        self.thumbPack = windowManager.folderData.thumbPack
+        self.uid = windowManager.folderData.openFolderData['uid']
+        self.thumbSize = windowManager.folderSettings['thumbSize']
+        self.done = 0
+        self.failed = 0
 
     def run(self):
+        self.put_progress()
+        folderData = self.wm.folderData
+        folderData.import_legacy_backups(self.folder)
+        self.wm.resizeEngine.run(
+            jobs = self.jobs(),
+            onDone = self.resize_done,
+            stopEvent = self._stop_event,
+            func = resize_and_thumbnail,
+            cost = resize_cost,
+        )
+        self.thumbIndex.save()
+
+    def jobs(self):
+        """ Yield resize jobs, backing each image up just before its job
+            is submitted
+        """
+
         for img in self.images:
-            print('Resize:', img)
-            imagePath = os.path.join(self.folder, img)
-            backup_and_resize(imagePath, self.folder, self.backupFolder, self.size)
-            thumbnails((imagePath, self.thumbFolder))
-            record = ImageUpdateRecord(
-                image=img, folder=self.wm.folderData.openFolderPath
+            try:
+                self.wm.folderData.backup_image(self.folder, img)
+            except OSError as e:
+                print('Failed to back up, not resized:', img, e)
+                self.done += 1
+                self.failed += 1
+                self.put_progress()
+                continue
+            yield img, (
+                os.path.join(self.folder, img), self.size,
+                None if self.thumbPack else self.thumbFolder,
+                (self.thumbSize,), (self.thumbSize,), # others remade when shown
             )
-            self.wm.put_image_update(record)
+
+    def resize_done(self, img, result, error):
+        self.done += 1
+        if error:
+            print('Failed to resize:', img, error)
+            self.failed += 1
+        else:
+            perfStats.incr('resize.done')
+            stat, made, info = result
+            patch_image_stats(self.folder, {img: stat})
+            if self.thumbPack:
+                for thumbSize, data in made.items():
+                    self.thumbPack.put(thumbSize, img, stat, data)
+            self.thumbIndex.record(img, stat, made)
+            self.wm.folderData.set_image_info(self.folder, img, stat, info)
+            self.wm.thumbCache.put(
+                ThumbCache.make_key(self.uid, img, self.thumbSize, stat),
+                made[self.thumbSize],
+            )
+            self.wm.put_image_update(ImageUpdateRecord(image=img, folder=self.folder))
+        self.put_progress()
+
+    def put_progress(self):
+        text = f'Resized { self.done }/{ len(self.images) }'
+        if self.failed:
+            text += f' ({ self.failed } failed)'
+        self.wm.put_image_update(ImageUpdateRecord(
+            image='resize', folder=self.folder, kind=PROGRESS, data=text,
+        ))
 
     def stop(self):
         self._stop_event.set()
 
 
+class ThreadedCopyApp(threading.Thread):
+    """ Copy images to a folder in a thread parallel to main window thread,
+        on a small pool of I/O workers using kernel-side copies
+        Progress and the per-file results are reported through imageUpdateQueue
+    """
+
+    def __init__(self, windowManager, folder, images, destFolder, numWorkers):
+        super().__init__(daemon=True)
+        self._stop_event = threading.Event()
+        self.wm = windowManager
+        self.folder = folder
+        self.images = images
+        self.destFolder = destFolder
+        self.numWorkers = numWorkers
+        self.results = {}
+
+    def run(self):
+        self.put_progress()
+        with concurrent.futures.ThreadPoolExecutor(self.numWorkers) as executor:
+            futures = {
+                executor.submit(self.copy_one, img): img for img in self.images
+            }
+            for future in concurrent.futures.as_completed(futures):
+                img = futures[future]
+                try:
+                    self.results[img] = future.result()
+                except Exception as e:
+                    print('Failed to copy:', img, e)
+                    self.results[img] = f'failed: { e }'
+                self.put_progress()
+        self.wm.put_image_update(ImageUpdateRecord(
+            image='copy', folder=self.folder, kind=COPY_DONE, data=dict(self.results),
+        ))
+
+    def copy_one(self, img):
+        if self._stop_event.is_set():
+            return 'cancelled'
+        return copy_image_file(os.path.join(self.folder, img), self.destFolder)
+
+    def put_progress(self):
+        self.wm.put_image_update(ImageUpdateRecord(
+            image='copy', folder=self.folder, kind=PROGRESS,
+            data=f'Copied { len(self.results) }/{ len(self.images) }',
+        ))
+
+    def stop(self):
+        self._stop_event.set()
+
+
+class ThreadedRestoreApp(threading.Thread):
+    """ Restore images to their originals (see FolderData.restore_image) in
+        a thread parallel to main window thread, as each restore hashes the
+        file it replaces
+        Progress, each restored image and the versions restored are reported
+        through imageUpdateQueue
+    """
+
+    def __init__(self, windowManager, folder, images):
+        super().__init__(daemon=True)
+        self._stop_event = threading.Event()
+        self.wm = windowManager
+        self.folder = folder
+        self.images = images
+        self.done = 0
+        self.restored = [] # versions restored
+
+    def run(self):
+        self.put_progress()
+        folderData = self.wm.folderData
+        folderData.import_legacy_backups(self.folder)
+        for img in self.images:
+            if self._stop_event.is_set():
+                break
+            try:
+                version, stat = folderData.restore_image(self.folder, img)
+            except KeyError:
+                pass
+            except OSError as e:
+                print('Failed to restore:', img, e)
+            else:
+                patch_image_stats(self.folder, {img: stat})
+                self.restored.append(version)
+                self.wm.put_image_update(ImageUpdateRecord(
+                    image=img, folder=self.folder, kind=MODIFIED,
+                ))
+            self.done += 1
+            self.put_progress()
+        perfStats.incr('backup.restored', len(self.restored))
+        self.wm.put_image_update(ImageUpdateRecord(
+            image='restore', folder=self.folder, kind=RESTORE_DONE,
+            data=(len(self.images), list(self.restored)),
+        ))
+
+    def put_progress(self):
+        self.wm.put_image_update(ImageUpdateRecord(
+            image='restore', folder=self.folder, kind=PROGRESS,
+            data=f'Restored { self.done }/{ len(self.images) }',
+        ))
+
+    def stop(self):
+        self._stop_event.set()
+
+
+class UpdateDispatcher():
+    """ Apply queued image update records within a per-tick time budget
+
+        Records are coalesced while they wait: repeated thumb updates for
+        an image are applied once, folder changes to one image are merged
+        into their net effect, and records for a folder that is no longer
+        open are dropped (except REPORT_KINDS: a copy or restore reports
+        its results even if another folder was opened meanwhile)
+
+        The queue holds (enqueue time, record) pairs, so the time each
+        record waited before it reached the window can be measured
+    """
+
+    def __init__(self, updateQueue, apply, frameBudget=0.04):
+        self.updateQueue = updateQueue
+        self.apply = apply
+        self.frameBudget = frameBudget
+        self.pending = OrderedDict()
+
+    @property
+    def busy(self):
+        return bool(self.pending)
+
+    def drain(self, openFolder):
+        """ Move everything queued into pending, coalescing as we go """
+
+        while True:
+            try:
+                queued, record = self.updateQueue.get_nowait()
+            except queue.Empty:
+                return
+            if record.folder != openFolder and record.kind not in REPORT_KINDS:
+                perfStats.incr('updates.dropped')
+                continue
+            if record.kind == THUMB:
+                self.pending.setdefault((record.image, THUMB), (queued, record))
+                continue
+            if record.kind not in (ADDED, REMOVED, MODIFIED):
+                # Eg progress: only the latest record matters
+                self.pending.pop((record.image, record.kind), None)
+                self.pending[(record.image, record.kind)] = (queued, record)
+                continue
+            key = (record.image, 'change')
+            old = self.pending.pop(key, None)
+            if old is not None:
+                queued = old[0]
+                record = record._replace(kind=self.merge_change(old[1].kind, record.kind))
+            self.pending[key] = (queued, record)
+
+    @staticmethod
+    def merge_change(old, new):
+        """ Return net kind of two folder changes to one image """
+
+        if new == REMOVED:
+            return REMOVED
+        if new == ADDED or old in (ADDED, REMOVED):
+            return ADDED
+        return MODIFIED
+
+    def dispatch(self, openFolder):
+        """ Apply pending records until the frame budget is spent;
+            Return number applied
+        """
+
+        self.drain(openFolder)
+        if self.pending:
+            perfStats.observe('updates.depth', len(self.pending))
+        deadline = time.perf_counter() + self.frameBudget
+        applied = 0
+        while self.pending and time.perf_counter() < deadline:
+            _, (queued, record) = self.pending.popitem(last=False)
+            if record.folder == openFolder or record.kind in REPORT_KINDS:
+                self.apply(record)
+                perfStats.observe_time('updates.latency', time.perf_counter() - queued)
+                applied += 1
+        perfStats.incr('updates.applied', applied)
+        return applied
+
+    def clear(self):
+        self.pending.clear()
+
+
+class PreviewWindow():
+    """ Window showing one image of the open gallery at screen size, with
+        next/previous in the gallery's current order
+
+        Images come from the window manager's previewCache; on each move
+        the image shown and the next few in the direction of travel are
+        decoded ahead by its PreviewLoader, so flipping through a burst
+        finds them ready. Until an image is ready its thumb is shown
+    """
+
+    prevKey = 'preview_prev'
+    nextKey = 'preview_next'
+    openKey = 'preview_open'
+    closeKey = 'preview_close'
+    titleKey = 'preview_title'
+    imageKey = 'preview_image'
+    readAhead = 4 # images decoded ahead in the direction of travel...
+    readBehind = 1 # ...and behind
+    marginWidth = 40
+    marginHeight = 120
+
+    def __init__(self, windowManager, image):
+        self.wm = windowManager
+        self.size = (
+            windowManager.screenWidth - self.marginWidth,
+            windowManager.screenHeight - self.marginHeight,
+        )
+        self.direction = 1
+        self.image = image
+        self.pos = 0
+        self.window = sg.Window('Preview', [
+            [
+                sg.Button('<', key=self.prevKey),
+                sg.Button('>', key=self.nextKey),
+                sg.Text('', key=self.titleKey, size=(80,1)),
+                sg.Button('Open in viewer', key=self.openKey),
+                sg.Button('Close', key=self.closeKey),
+            ],
+            [sg.Image(key=self.imageKey, size=self.size)],
+        ], return_keyboard_events=True, finalize=True)
+        self.show(image)
+
+    def read(self):
+        """ Handle the preview window's pending events; Return False once closed """
+
+        event, _ = self.window.read(timeout=0)
+        key = event.split(':')[0] if isinstance(event, str) else event # eg 'Right:114'
+        if event is None or key in (self.closeKey, 'Escape'):
+            self.close()
+            return False
+        if key in (self.nextKey, 'Right', 'space'):
+            self.move(1)
+        elif key in (self.prevKey, 'Left', 'BackSpace'):
+            self.move(-1)
+        elif key == self.openKey:
+            self.wm.open_image(self.image)
+        return True
+
+    def move(self, step):
+        order = self.wm.order
+        if not order:
+            return
+        self.direction = step
+        self.show(order[max(0, min(len(order) - 1, self.position() + step))])
+
+    def position(self):
+        """ Return index of the image shown in the gallery order,
+            which may have changed since it was shown
+        """
+
+        order = self.wm.order
+        if self.pos < len(order) and order[self.pos] == self.image:
+            return self.pos
+        if self.image in order:
+            return order.index(self.image)
+        return min(self.pos, len(order) - 1) # removed meanwhile
+
+    def show(self, image):
+        """ Show image and read ahead its neighbours """
+
+        perfStats.incr('preview.shown')
+        self.image = image
+        self.pos = self.position()
+        self.display()
+        self.read_ahead()
+
+    def display(self):
+        stats = image_stats(self.wm.folderData.openFolderPath)
+        if self.image not in stats:
+            return
+        data = self.wm.previewCache.get(self.cache_key(self.image, stats))
+        title = f'{ self.image }  ({ self.pos + 1 }/{ len(self.wm.order) })'
+        if data is None:
+            perfStats.incr('preview.waited')
+            data = self.wm.thumb_data(self.image, stats)
+            title += '  loading...'
+        self.window[self.titleKey].update(title)
+        if data is not None:
+            self.window[self.imageKey].update(data=data)
+
+    def cache_key(self, image, stats):
+        return ThumbCache.make_key(
+            self.wm.folderData.openFolderData['uid'], image, self.size, stats[image]
+        )
+
+    def read_ahead(self):
+        folder = self.wm.folderData.openFolderPath
+        stats = image_stats(folder)
+        order = self.wm.order
+        positions = [self.pos] + [
+            self.pos + self.direction*i for i in range(1, self.readAhead + 1)
+        ] + [
+            self.pos - self.direction*i for i in range(1, self.readBehind + 1)
+        ]
+        self.wm.preview_loader().request(
+            ((folder, self.cache_key(img, stats)), (os.path.join(folder, img), self.size))
+            for img in (order[pos] for pos in positions if 0 <= pos < len(order))
+            if img in stats
+        )
+
+    def preview_ready(self, image):
+        if image == self.image:
+            self.display()
+
+    def close(self):
+        self.window.close()
+
+
 class WindowManager():
     """ Keep track of when we need to remake the window """
 
     selectFolderKey = 'select_folder'
     resizeInputKey = 'resize_input'
     resizeButtonKey = 'resize_button'
-    sortRatingButtonKey = 'sort_rating_button'
-    sortNameButtonKey = 'sort_name_button'
+    restoreButtonKey = 'restore_button'
+    sortKey = 'sort_by'
     copyButtonKey = 'copy_button'
     copyInputKey = 'copy_input'
+    statsButtonKey = 'stats_button'
+    statusKey = 'status'
+    galleryKey = 'gallery'
+    pagePrevKey = 'page_prev'
+    pageNextKey = 'page_next'
+    pageTextKey = 'page_text'
+    thumbSizeKey = 'thumb_size'
     thumbSize = 'S'
+    sortLabels = {
+        'Name': SORT_NAME,
+        'Rating': SORT_RATING,
+        'Capture time': SORT_CAPTURED,
+        'Modified': SORT_MTIME,
+        'File size': SORT_SIZE,
+        'Dimensions': SORT_PIXELS,
+        'Similar': SORT_SIMILAR,
+        'Sharpness': SORT_SHARPNESS,
+        'Brightness': SORT_BRIGHTNESS,
+        'Clipping': SORT_CLIPPED,
+        'Contrast': SORT_CONTRAST,
+    }
     imgDim = THUMBNAIL_SIZES[thumbSize]
     loadingThumbPath = THUMBNAIL_LOAD_PATHS[thumbSize]
-    screenWidth, _ = sg.Window.get_screen_size()
+    screenWidth = screenHeight = None # measured when the first window manager is made
     scrollBarWidth = 20
     frameExcessWidth = 28
-    gridCols = max(1, math.floor((screenWidth - scrollBarWidth)/(imgDim + frameExcessWidth)))
-    folderData = FolderData()
+    frameExcessHeight = 70
+    menuHeight = 100
+    bufferRows = 1
+    gridCols = pageRows = None # set from screen size by set_thumb_size
+    folderData = None # made by the first window manager
     folderSettings = {
         'thumbSize': thumbSize,
     }
-    imageUpdateQueue = Queue()
+    imageUpdateQueue = queue.SimpleQueue() # only threads put here
+    thumbWorkers = None # None: one per CPU
+    resizeWorkers = None # None: one per CPU
+    previewWorkers = 2 # the image shown, and the next one read ahead
+    # Made by the first window manager, so the worker counts can be set first
+    thumbEngine = resizeEngine = previewEngine = None
+    copyWorkers = 4 # I/O bound: more workers than disks rarely helps
+    thumbCacheBytes = 256*1024*1024
+    thumbCache = ThumbCache(maxBytes=thumbCacheBytes)
+    previewCacheBytes = 64*1024*1024 # screen-sized PNGs: a few dozen
+    previewCache = ThumbCache(maxBytes=previewCacheBytes)
 
     def __init__(self, cols=None):
         self.folder = None
         self.window = None
+        self.watcher = None
+        self.thumbJobs = None # ThumbJobManager, started on first use
+        self.preview = None # PreviewWindow while one is open
+        self.previewLoader = None # PreviewLoader, started on first use
+        self.fixedCols = cols
         if cols:
             self.gridCols = cols
-        self.sortByRating = False
+        if WindowManager.folderData is None:
+            WindowManager.folderData = FolderData()
+        if WindowManager.thumbEngine is None:
+            WindowManager.thumbEngine = ThumbEngine(numWorkers=self.thumbWorkers)
+            WindowManager.resizeEngine = ThumbEngine(numWorkers=self.resizeWorkers)
+            WindowManager.previewEngine = ThumbEngine(numWorkers=self.previewWorkers)
+        if WindowManager.screenWidth is None:
+            WindowManager.screenWidth, WindowManager.screenHeight = sg.Window.get_screen_size()
+        self.set_thumb_size(self.thumbSize)
+        self.sortBy = SORT_NAME
+        # Gallery grid is a fixed pool of cells bound to a page of self.order
+        self.order = []
+        self.pageStart = 0
+        self.cellImages = []
+        self.cellVisible = []
+        self.imageCells = {}
+        self.selected = set()
+        self.readyThumbs = set()
+        self.dispatcher = UpdateDispatcher(self.imageUpdateQueue, self.update_image)
+
+    def set_thumb_size(self, thumbSize):
+        """ Switch displayed thumb size; thumbs are made at the displayed
+            size only, so missing ones of the new size are made as the pages
+            are shown (from a larger thumb of the image, where there is one)
+        """
+
+        self.thumbSize = thumbSize
+        self.imgDim = THUMBNAIL_SIZES[thumbSize]
+        self.loadingThumbPath = THUMBNAIL_LOAD_PATHS[thumbSize]
+        self.folderSettings['thumbSize'] = thumbSize
+        if not self.fixedCols:
+            self.gridCols = max(1, math.floor(
+                (self.screenWidth - self.scrollBarWidth)/(self.imgDim + self.frameExcessWidth)
+            ))
+        self.pageRows = self.bufferRows + max(1, math.floor(
+            (self.screenHeight - self.menuHeight)/(self.imgDim + self.frameExcessHeight)
+        ))
+        self.readyThumbs = set()
+
+    @property
+    def pageSize(self):
+        return self.gridCols*self.pageRows
 
     @property
     def folderShortName(self):
         return self.folderData.folderShortName if self.folder else ''
 
     def put_image_update(self, img):
-        self.imageUpdateQueue.put(img)
+        self.imageUpdateQueue.put((time.perf_counter(), img))
+
+    def watch_folder(self):
+        """ Replace folder watcher with one for the open folder """
+
+        self.stop_watching()
+        folder = self.folderData.openFolderPath
+        self.watcher = FolderWatcher(
+            folder,
+            onChange = lambda kind, img: self.put_image_update(
+                ImageUpdateRecord(image=img, folder=folder, kind=kind)
+            ),
+        )
+        self.watcher.start()
+
+    def stop_watching(self):
+        if self.watcher:
+            self.watcher.stop()
+            self.watcher = None
 
     def window_event_loop(self):
         while True:
-            event, values = self.window.read(timeout=100)
+            # Come straight back while updates are waiting
+            event, values = self.window.read(
+                timeout=0 if self.dispatcher.busy else 10 if self.preview else 100
+            )
+            tickStart = time.perf_counter()
             # if event and event != '__TIMEOUT__':
             #     print('-- Event:\n', event, values)
 
             # Handle events
             if event is None:
                 # Event: close main window
+                self.close_preview()
+                self.stop_watching()
                 self.folderData.update_save_folder_data()
                 return event
             if event == self.selectFolderKey:
                 # Event: close folder select window
                 if not values[self.selectFolderKey]:
                     continue
+                self.close_preview()
                 self.folder = self.folderData.open_folder(
                     folderPath = values[self.selectFolderKey],
                     settings   = self.folderSettings,
                     windowManager = self,
                 )
-                self.sortByRating = False
+                self.sortBy = SORT_NAME
+                self.pageStart = 0
+                self.selected = set()
+                self.readyThumbs = set()
                 self.kickoff_thumb_threads()
+                self.watch_folder()
                 return event
+            if isinstance(event, CellKey):
+                # Event: user clicked part of a gallery cell
+                cellKey, event = event, self.bound_image_key(event)
             if isinstance(event, ImageKey):
                 # Event: user clicked part of an image frame
+                if event.element == 'check':
+                    self.set_checked(event.image, values[cellKey])
                 if event.element[:4] == 'star':
                     rating = int(event.element[-1])
                     self.folderData.set_rating(event.image, rating)
@@ -281,58 +1377,67 @@ class WindowManager():
                 if event.element == 'img':
                     self.toggle_check(event.image)
                 if event.element == 'open':
-                    self.open_image(event.image)
-            if event == self.sortRatingButtonKey:
-                if self.folder:
-                    self.sortByRating = True
-                    self.kickoff_thumb_threads()
+                    self.open_preview(event.image)
+            if event == self.sortKey:
+                sortBy = self.sortLabels.get(values[self.sortKey])
+                if self.folder and sortBy:
+                    self.sort_gallery(sortBy)
+            if event == self.thumbSizeKey:
+                thumbSize = values[self.thumbSizeKey]
+                if thumbSize in THUMBNAIL_SIZES and thumbSize != self.thumbSize:
+                    self.set_thumb_size(thumbSize)
+                    if self.folder:
+                        self.kickoff_thumb_threads()
                     return event
-            if event == self.sortNameButtonKey:
+            if event == self.pageNextKey:
                 if self.folder:
-                    self.sortByRating = False
-                    self.kickoff_thumb_threads()
-                    return event
+                    self.change_page(1)
+            if event == self.pagePrevKey:
+                if self.folder:
+                    self.change_page(-1)
             if event == self.resizeButtonKey:
                 if self.folder:
                     self.kickoff_resize_threads()
+            if event == self.restoreButtonKey:
+                if self.folder:
+                    self.restore_selected()
             if event == self.copyButtonKey:
                 if self.folder and values[self.copyInputKey]:
                     self.copy_to_subfolder(dest=values[self.copyInputKey])
+            if event == self.statsButtonKey:
+                sg.popup_scrolled(
+                    perfStats.report(), title='Stats', size=(100, 30), non_blocking=True,
+                )
 
-            # Poll queue and update images
-            records = self.batch_poll_img_queue(batchSize=8)
-            for record in records:
-                self.update_image(record)
+            if self.preview and not self.preview.read():
+                # Event: preview window closed
+                self.preview = None
+
+            # Write batched metadata changes
+            self.folderData.flush_if_due()
+
+            # Apply queued image updates within this tick's time budget
+            self.dispatcher.dispatch(self.folderData.openFolderPath)
+            perfStats.observe_time('loop.tick', time.perf_counter() - tickStart)
 
             # Place at very end of event loop for debug window
             if event == sg.TIMEOUT_KEY:
                 continue
 
-    def batch_poll_img_queue(self, batchSize=4):
-        """ Return batch of image update records from queue """
-
-        records = []
-        for i in range(batchSize):
-            try:
-                records.append(self.imageUpdateQueue.get(block=False))
-            except queue.Empty:
-                break
-        return records
-
     def get_selected_images(self):
-        return [
-            img for img in self.folderData.images()
-            if self.window[ImageKey(img, 'check')].get()
-        ]
-
-    def kickoff_thumb_threads(self):
-        print('Kick off thumbnail thread')
-        src = self.folderData.openFolderPath
-        dest = self.folderData.openFolderData['thumbnailFolder']
-        ThreadedThumbApp(self, src, dest, list_images(src)).start()
+        return [img for img in self.folderData.images() if img in self.selected]
+
+    def kickoff_thumb_threads(self, images=None):
+        perfStats.incr('thumb.kickoffs')
+        if self.thumbJobs is None:
+            self.thumbJobs = ThumbJobManager(self)
+            self.thumbJobs.start()
+        self.thumbJobs.request(
+            self.folderData.images() if images is None else images, self.thumbSize
+        )
 
     def kickoff_resize_threads(self):
-        print('Kick off resize thread')
+        perfStats.incr('resize.kickoffs')
         src = self.folderData.openFolderPath
         selected = self.get_selected_images()
         newSize = self.window[self.resizeInputKey].get()
@@ -345,39 +1450,218 @@ class WindowManager():
         else:
             ThreadedResizeApp(
                 windowManager=self, folder=src, images=selected, size=newSize,  
-                backupFolder=self.folderData.openFolderData['backupsFolder'], 
                 thumbFolder=self.folderData.openFolderData['thumbnailFolder'], 
             ).start()
 
+    def restore_selected(self):
+        """ Put the originals of the selected images back, in the background
+            (see ThreadedRestoreApp)
+        """
+
+        selected = self.get_selected_images()
+        if not selected:
+            sg.Popup('No images selected', title='None selected')
+            return
+        ThreadedRestoreApp(
+            windowManager=self, folder=self.folderData.openFolderPath, images=selected,
+        ).start()
+
+    def restore_done(self, selected, restored):
+        """ Report results of a background restore: the versions restored
+            out of selected images
+        """
+
+        originals = restored.count(ORIGINAL_VERSION)
+        message = f'Restored { originals } of { selected } to the original'
+        if originals < len(restored):
+            message += (
+                f'\n\n{ len(restored) - originals } to the oldest version kept,'
+                ' as backups gc dropped the original'
+            )
+        if len(restored) < selected:
+            message += '\n\nThe others have no backup (never resized)'
+        sg.popup(message, title='Restore')
+
     def update_image(self, imageUpdateRecord):
-        image, folder = imageUpdateRecord
-        if folder != self.folderData.openFolderPath:
-            print('Folder no longer open:', folder)
+        image, folder, kind, data = imageUpdateRecord
+        if folder != self.folderData.openFolderPath and kind not in REPORT_KINDS:
+            perfStats.incr('updates.dropped')
+            return
+        if kind == PROGRESS:
+            self.window[self.statusKey].update(data)
+            return
+        if kind == COPY_DONE:
+            self.copy_done(data)
+            return
+        if kind == RESTORE_DONE:
+            self.restore_done(*data)
+            return
+        if kind == PREVIEW:
+            if self.preview:
+                self.preview.preview_ready(image)
             return
-        key = ImageKey(image, 'img')
-        thumb = self.folderData.thumb_path(image)
-        elem = self.window[key]
-        if not elem:
-            print('Image not found:', image)
-            pass
+        if kind != THUMB:
+            self.apply_folder_change(image, kind)
+            return
+        self.readyThumbs.add(image)
+        cell = self.imageCells.get(image)
+        if cell is None:
+            return
+        data = self.thumb_data(image)
+        if data is not None:
+            perfStats.incr('updates.thumbs')
+            self.window[CellKey(cell, 'img')].update(data=data)
+
+    def thumb_data(self, image, stats=None):
+        """ Return PNG bytes of image's thumb from the cache, reading the
+            thumb file into the cache on a miss; Return None if unavailable
+        """
+
+        if stats is None:
+            stats = image_stats(self.folderData.openFolderPath)
+        if image not in stats:
+            return None
+        key = ThumbCache.make_key(
+            self.folderData.openFolderData['uid'], image, self.thumbSize, stats[image]
+        )
+        data = self.thumbCache.get(key)
+        if data is None:
+            data = self.folderData.thumb_bytes(image, stats[image])
+            if data is None:
+                return None
+            self.thumbCache.put(key, data)
+        return data
+
+    def apply_folder_change(self, image, kind):
+        """ Patch metadata and grid for one image added, removed or modified
+            while the folder is open
+        """
+
+        perfStats.incr(f'folder.{ kind }')
+        if kind == REMOVED:
+            self.folderData.remove_image(image)
+            self.selected.discard(image)
+            self.readyThumbs.discard(image)
+            if image in self.order:
+                self.order.remove(image)
+                self.bind_page()
+            return
+        self.folderData.add_image(image) # new, or refresh its sort attributes
+        if image not in self.order:
+            # Similar groups need hashes; until then images sit in name order
+            sortBy = SORT_NAME if self.sortBy == SORT_SIMILAR else self.sortBy
+            self.order.insert(
+                self.folderData.sortIndex.position(self.order, sortBy, image), image
+            )
+            self.bind_page()
+        self.kickoff_thumb_threads(images=[image])
+
+    def bound_image_key(self, cellKey):
+        """ Return ImageKey for the image bound to a cell, or None """
+
+        image = self.cellImages[cellKey.cell]
+        return ImageKey(image, cellKey.element) if image is not None else None
+
+    def sort_gallery(self, sortBy):
+        """ Reorder the open gallery in place: rebind the cell pool to the
+            new order, keeping selection and already loaded thumbnails
+        """
+
+        self.sortBy = sortBy
+        _, names = self.folderData.sorted_thumbs_names(sortBy)
+        self.order = list(names)
+        self.pageStart = 0
+        self.bind_page()
+
+    def change_page(self, step):
+        self.pageStart += step*self.pageSize
+        self.bind_page()
+
+    def bind_page(self):
+        """ Bind the cell pool to the images of the current page """
+
+        lastPageStart = max(0, (len(self.order) - 1)//self.pageSize*self.pageSize)
+        self.pageStart = max(0, min(self.pageStart, lastPageStart))
+        images = self.order[self.pageStart:self.pageStart + self.pageSize]
+        stats = image_stats(self.folderData.openFolderPath)
+        self.imageCells = {}
+        for cell in range(self.pageSize):
+            self.bind_cell(cell, images[cell] if cell < len(images) else None, stats)
+        self.window[self.pageTextKey].update(
+            f'{ self.pageStart//self.pageSize + 1 }'
+            f'/{ max(1, math.ceil(len(self.order)/self.pageSize)) }'
+        )
+        if self.thumbJobs:
+            self.thumbJobs.prioritize(self.order, self.pageStart, self.pageSize)
+
+    def bind_cell(self, cell, image, stats):
+        """ Show image in cell (hide cell if image is None) """
+
+        # Cells are shown again in ascending order, which keeps grid order
+        if self.cellVisible[cell] != (image is not None):
+            self.cellVisible[cell] = image is not None
+            self.window[CellKey(cell, 'frame')].update(visible=image is not None)
+        if image is None:
+            self.cellImages[cell] = None
+            return
+        self.imageCells[image] = cell
+        if self.cellImages[cell] == image:
+            return
+        self.cellImages[cell] = image
+        title = image if len(image) <= 50 else '...' + image[-47:]
+        self.window[CellKey(cell, 'frame')].update(value=title)
+        self.window[CellKey(cell, 'check')].update(image in self.selected)
+        self.update_star_display(image)
+        data = self.thumb_data(image, stats) if image in self.readyThumbs else None
+        if data is not None:
+            self.window[CellKey(cell, 'img')].update(data=data)
         else:
-            print('Updated:', thumb)
-            self.window[key].update(thumb)
+            self.window[CellKey(cell, 'img')].update(self.loadingThumbPath)
 
     def update_star_display(self, image):
+        cell = self.imageCells.get(image)
+        if cell is None:
+            return
         rating = self.folderData.get_rating(image)
         for i in range(4):
-            ik = ImageKey(image, f'star{ i }')
+            ck = CellKey(cell, f'star{ i }')
             if rating >= i:
-                self.window[ik].update('imgs/full_star.png')
+                self.window[ck].update('imgs/full_star.png')
             else:
-                self.window[ik].update('imgs/empty_star.png')
+                self.window[ck].update('imgs/empty_star.png')
+
+    def set_checked(self, image, checked):
+        if checked:
+            self.selected.add(image)
+        else:
+            self.selected.discard(image)
 
     def toggle_check(self, image):
-        ik = ImageKey(image, 'check')
-        self.window[ik].update(not self.window[ik].get())
+        self.set_checked(image, image not in self.selected)
+        cell = self.imageCells.get(image)
+        if cell is not None:
+            self.window[CellKey(cell, 'check')].update(image in self.selected)
+
+    def open_preview(self, image):
+        if self.preview:
+            self.preview.show(image)
+        else:
+            self.preview = PreviewWindow(self, image)
+
+    def close_preview(self):
+        if self.preview:
+            self.preview.close()
+            self.preview = None
+
+    def preview_loader(self):
+        if self.previewLoader is None:
+            self.previewLoader = PreviewLoader(self)
+            self.previewLoader.start()
+        return self.previewLoader
 
     def open_image(self, image):
+        """ Open image in the platform's default viewer """
+
         try:
             open_image(os.path.join(self.folderData.openFolderPath, image))
         except KeyError:
@@ -385,7 +1669,9 @@ class WindowManager():
             print('Invalid platform, no action taken')
 
     def copy_to_subfolder(self, dest):
-        """ Copy selected images to subfolder dest in gallery dir """
+        """ Copy selected images to subfolder dest in gallery dir
+            (in the background; see copy_done)
+        """
 
         src = self.folderData.openFolderPath
         selected = self.get_selected_images()
@@ -403,21 +1689,31 @@ class WindowManager():
             print('Exception while making subfolder:')
             print(e)
             return
-        try:
-            for img in selected:
-                shutil.copy2(os.path.join(src, img), newSubfolder)
-        except Exception as e:
-            sg.popup(
-                'Unable to copy files. This may be due to permission errors or OS errors.',
-                title='Copy failed',
+        ThreadedCopyApp(
+            windowManager=self, folder=src, images=selected,
+            destFolder=newSubfolder, numWorkers=self.copyWorkers,
+        ).start()
+
+    def copy_done(self, results):
+        """ Report results of a background copy """
+
+        counts = {}
+        for outcome in results.values():
+            outcome = outcome.split(':')[0]
+            counts[outcome] = counts.get(outcome, 0) + 1
+        failed = [img for img, outcome in results.items() if outcome.startswith('failed')]
+        copied = counts.get('copied', 0)
+        message = f'Copied { copied } { "file" if copied == 1 else "files" }'
+        if counts.get('skipped'):
+            message += f', skipped { counts["skipped"] } already identical'
+        if failed:
+            message += (
+                f'\n\nUnable to copy { len(failed) } '
+                f'(permission or OS errors):\n' + '\n'.join(failed[:20])
             )
-            print('Exception while copying files:')
-            print(e)
-            return
-        sg.popup(
-            f'Copied { len(selected) } { "file" if len(selected) == 1 else "files" }', 
-            title='Success!'
-        )
+            if len(failed) > 20:
+                message += f'\n... and { len(failed) - 20 } more'
+        sg.popup(message, title='Copy failed' if failed else 'Success!')
 
     def menu_layout(self):
         resizeFrame = sg.Frame(
@@ -426,13 +1722,27 @@ class WindowManager():
                 sg.Button('Resize:', key=self.resizeButtonKey, enable_events=True),
                 sg.InputText('100', key=self.resizeInputKey, size=(6,1), enable_events=False),
                 sg.Text('%', size=(2,1), enable_events=False),
+                sg.Button('Restore', key=self.restoreButtonKey, enable_events=True),
             ]]
         )
         sortFrame = sg.Frame(
             'Sort',
             [[
-                sg.Button('By Rating', key=self.sortRatingButtonKey, enable_events=True),
-                sg.Button('By Name', key=self.sortNameButtonKey, enable_events=True),
+                sg.Combo(
+                    list(self.sortLabels), key=self.sortKey, readonly=True, enable_events=True,
+                    default_value=next(
+                        label for label, sortBy in self.sortLabels.items() if sortBy == self.sortBy
+                    ),
+                ),
+            ]]
+        )
+        thumbSizeFrame = sg.Frame(
+            'Thumbs',
+            [[
+                sg.Combo(
+                    list(THUMBNAIL_SIZES), default_value=self.thumbSize,
+                    key=self.thumbSizeKey, readonly=True, enable_events=True,
+                ),
             ]]
         )
         moveFrame = sg.Frame(
@@ -442,40 +1752,49 @@ class WindowManager():
                 sg.InputText('', key=self.copyInputKey, size=(12,1), enable_events=False),
             ]]
         )
+        statsFrame = sg.Frame(
+            'Stats',
+            [[
+                sg.Button('Stats', key=self.statsButtonKey, enable_events=True),
+            ]]
+        )
+        pageFrame = sg.Frame(
+            'Page',
+            [[
+                sg.Button('<', key=self.pagePrevKey, enable_events=True),
+                sg.Text('1/1', key=self.pageTextKey, size=(9,1), justification='center'),
+                sg.Button('>', key=self.pageNextKey, enable_events=True),
+            ]]
+        )
         openGalleryFrame = sg.Frame(
             'Open gallery',
             [[
                 sg.FolderBrowse('Open gallery', target=self.selectFolderKey),
-                sg.Text(f'Folder: { self.folderShortName }', size=(60,1)),
+                sg.Text(f'Folder: { self.folderShortName }', size=(40,1)),
+                sg.Text('', key=self.statusKey, size=(30,1)),
             ]]
         )
         return [
-            resizeFrame, sortFrame, moveFrame, openGalleryFrame, 
+            resizeFrame, sortFrame, thumbSizeFrame, pageFrame, moveFrame, statsFrame, openGalleryFrame, 
             sg.InputText(key=self.selectFolderKey, enable_events=True, visible=False),
         ]
 
-    def gallery_element(self, elemData):
-        image = os.path.basename(elemData['img'])
-        title = image
-        # imgSize = image_size(elemData['thumb'])
-        rating = self.folderData.get_rating(image)
-        if rating is None: 
-            rating = -1
-        # xPad = (self.imgDim - imgSize[0])//2
-        # yPad = (self.imgDim - imgSize[1])//2
+    def gallery_element(self, cell):
+        """ Return one pooled gallery cell; images are bound to it later """
+
         check = [
             sg.Check('', 
                 enable_events=True, 
                 pad=(30,0),
-                key=ImageKey(image, element='check'),
+                key=CellKey(cell, element='check'),
             )
         ]
         ratingStars = [   
             sg.Image(
-                'imgs/full_star.png' if i <= rating else 'imgs/empty_star.png',
+                'imgs/empty_star.png',
                 enable_events=True,
                 pad=(2,0),
-                key=ImageKey(image, element=f'star{ i }'),
+                key=CellKey(cell, element=f'star{ i }'),
             )
             for i in range(4)
         ]
@@ -484,57 +1803,38 @@ class WindowManager():
                 'imgs/open_icon.png',
                 enable_events=True,
                 pad=(30,0),
-                key=ImageKey(image, element=f'open'),
+                key=CellKey(cell, element=f'open'),
             )
         ]
         layout = [
             check + ratingStars + openIcon,
             [
                 sg.Image(
-                    elemData['thumb'],
-                    # pad=(xPad, yPad), 
+                    self.loadingThumbPath,
                     enable_events=True,
-                    key=ImageKey(image, element='img'),
+                    key=CellKey(cell, element='img'),
                 )
             ],
         ]
-        if len(title) > 50:
-            title = '...' + title[-47:]
         return sg.Frame(
-            title, layout, 
-            element_justification = 'center'
-        )
-
-    def gallery_row_element(self, rowData):
-        return [
-            self.gallery_element(elemData={
-                'row': rowData['row'],
-                'col': col,
-                'img': data['name'],
-                'thumb': self.loadingThumbPath, #data['thumb'],
-            })
-            for col, data in enumerate(rowData['imageDatas'])
-            if data
-        ]
-
-    def image_data_grid(self, thumbs, imgNames):
-        return to_grid(
-            arr = [{'thumb': t, 'name': n} for t, n in zip(thumbs, imgNames)], 
-            numCols = self.gridCols,
+            '', layout, 
+            element_justification = 'center',
+            key=CellKey(cell, element='frame'),
         )
 
     def gallery_layout(self):
+        """ Return grid of pooled cells; page size doesn't depend on folder size """
+
         if self.folder:
-            thumbs, names = self.folderData.sorted_thumbs_names(self.sortByRating)
-            imgDataGrid = self.image_data_grid(thumbs=thumbs, imgNames=names)
-            rowDataDicts = [
-                {'row': row, 'imageDatas': imageDatas}
-                for row, imageDatas in enumerate(imgDataGrid)
-            ]
-            return [
-                self.gallery_row_element(rowData)
-                for row, rowData in enumerate(rowDataDicts)
-            ]
+            _, names = self.folderData.sorted_thumbs_names(self.sortBy)
+            self.order = list(names)
+            self.cellImages = [None]*self.pageSize
+            self.cellVisible = [True]*self.pageSize
+            self.imageCells = {}
+            return to_grid(
+                arr = [self.gallery_element(cell) for cell in range(self.pageSize)],
+                numCols = self.gridCols,
+            )
         else:
             return [[ sg.Text('', size=(100,40)) ]]
 
@@ -545,9 +1845,10 @@ class WindowManager():
                 self.gallery_layout(), 
                 size = (
                     self.gridCols*(self.imgDim + 30),
-                    sg.Window.get_screen_size()[1]-100
+                    self.screenHeight - self.menuHeight
                 ), 
                 pad = (0,0),
+                key = self.galleryKey,
                 scrollable = True,
                 vertical_scroll_only = True,
             )],
@@ -565,12 +1866,309 @@ class WindowManager():
     def run_window(self):
         eventLoopResult = True
         while eventLoopResult:
-            newWindow = sg.Window('Gallery', self.layout())
+            newWindow = sg.Window('Gallery', self.layout(), finalize=True)
             self.close_window()
             self.window = newWindow
+            if self.folder:
+                self.bind_page()
             eventLoopResult = self.window_event_loop()
 
 
+def prebuild(folders, numWorkers=None, sizes=(WindowManager.thumbSize,)):
+    """ Register folders in the folder metadata and make their thumbnails
+        in the same layout the gallery window uses, without a display
+        Resumable: thumbs already in the thumb index are skipped
+    """
+
+    folderData = FolderData()
+    engine = ThumbEngine(numWorkers=numWorkers)
+    totals = {'images': 0, 'made': 0, 'fresh': 0, 'failed': 0}
+    start = time.perf_counter()
+    try:
+        for folder in folders:
+            counts = prebuild_folder(folderData, engine, folder, sizes)
+            for k in totals:
+                totals[k] += counts[k]
+    except KeyboardInterrupt:
+        print('Interrupted; progress is saved, run again to resume')
+    finally:
+        # Metadata first: it is what makes a rerun resume
+        folderData.update_save_folder_data()
+        engine.close()
+    seconds = time.perf_counter() - start
+    print(
+        f'Total: { totals["images"] } images in { len(folders) } folders, '
+        f'{ totals["made"] } made, { totals["fresh"] } already fresh, '
+        f'{ totals["failed"] } failed, { seconds:.1f}s '
+        f'({ totals["made"]/seconds if seconds else 0:.1f} thumbs/s, '
+        f'{ engine.numWorkers } workers)'
+    )
+    return totals
+
+def prebuild_folder(folderData, engine, folder, sizes):
+    # Same path form as the folder browser gives the gallery window
+    folderPath = os.path.abspath(folder).replace(os.sep, '/')
+    folderData.open_folder(folderPath, settings={'thumbSize': sizes[-1]}, windowManager=None)
+    thumbIndex = folderData.thumbIndex
+    thumbPack = folderData.thumbPack
+    dest = folderData.openFolderData['thumbnailFolder']
+    stats = image_stats(folderPath)
+    statuses = [folderData.thumb_status(stats, size) for size in sizes]
+    todo = [img for img in stats if any(status[img] != FRESH for status in statuses)]
+    counts = {'images': len(stats), 'made': 0, 'fresh': len(stats) - len(todo), 'failed': 0}
+    start = time.perf_counter()
+
+    def thumb_done(img, result, error):
+        if error:
+            print('Failed to create thumb:', img, error)
+            counts['failed'] += 1
+            return
+        made, info = result
+        if thumbPack:
+            for thumbSize, data in made.items():
+                thumbPack.put(thumbSize, img, stats[img], data)
+        thumbIndex.record(img, stats[img], made)
+        folderData.set_image_info(folderPath, img, stats[img], info)
+        counts['made'] += 1
+        if counts['made'] % ThumbJobManager.saveEvery == 0:
+            thumbIndex.save()
+
+    def info_done(batch, result, error):
+        if not error:
+            for img, info in zip(batch, result):
+                if info:
+                    folderData.set_image_info(folderPath, img, stats[img], info)
+
+    try:
+        engine.run(
+            jobs = (
+                (img, (os.path.join(folderPath, img), None if thumbPack else dest, sizes))
+                for img in todo
+            ),
+            onDone = thumb_done,
+            cost = thumbnail_cost,
+        )
+        # Thumbs made before image info was recorded: read it without a decode
+        engine.run(
+            jobs = (
+                (batch, [
+                    (
+                        os.path.join(folderPath, img),
+                        thumbPack.get(sizes[-1], img) if thumbPack else
+                        os.path.join(dest, f'{ sizes[-1] }_{ os.path.splitext(img)[0] }.png'),
+                    )
+                    for img in batch
+                ])
+                for batch in batches(
+                    folderData.images_without_info(folderPath, stats), ThumbJobManager.infoBatch
+                )
+            ),
+            onDone = info_done,
+            func = read_image_info,
+        )
+    finally:
+        thumbIndex.save()
+        if thumbPack:
+            thumbPack.compact_if_due()
+    seconds = time.perf_counter() - start
+    print(
+        f'{ folderPath }: { counts["images"] } images, { counts["made"] } made, '
+        f'{ counts["fresh"] } already fresh, { counts["failed"] } failed, '
+        f'{ seconds:.1f}s'
+    )
+    return counts
+
+def registered_folder(folderData, folder):
+    """ Return the registry path of a gallery folder, or None if it has never been opened """
+
+    folderPath = os.path.abspath(folder).replace(os.sep, '/')
+    if folderPath not in folderData.allFolderData:
+        print(f'{ folder }: not a gallery folder (open or prebuild it first)')
+        return None
+    return folderPath
+
+def list_backups(folder, images=()):
+    """ Print the backup versions of images in folder (default: all) """
+
+    folderData = FolderData()
+    folderPath = registered_folder(folderData, folder)
+    if folderPath is None:
+        return
+    folderData.import_legacy_backups(folderPath)
+    uid = folderData.allFolderData[folderPath]['uid']
+    for row in folderData.store.backups(uid):
+        if images and row['name'] not in images:
+            continue
+        print(
+            f'{ row["name"] }  v{ row["version"] }  '
+            f'{ time.strftime("%Y-%m-%d %H:%M", time.localtime(row["time"])) }  '
+            f'{ row["size"]/1e6:.1f} MB  { row["hash"][:12] }'
+        )
+
+def restore_backups(folder, images, version=None):
+    """ Restore images in folder to a backup version (default: the original) """
+
+    folderData = FolderData()
+    folderPath = registered_folder(folderData, folder)
+    if folderPath is None:
+        return
+    folderData.import_legacy_backups(folderPath)
+    for img in images:
+        try:
+            restored, _ = folderData.restore_image(folderPath, img, version)
+        except KeyError as e:
+            print('Not restored:', e.args[0])
+        else:
+            original = ' (the original)' if restored == ORIGINAL_VERSION else ''
+            print(f'Restored { img } to v{ restored }{ original }')
+
+def collect_backups(maxAge=None, maxSize=None):
+    """ Garbage collect the backup store: drop versions older than maxAge
+        seconds, then the oldest versions until the objects kept take at
+        most maxSize bytes, then delete objects no version refers to
+        Originals (each image's first version) are what restore puts back,
+        so they are never dropped for age, and for size only once every
+        later version is gone
+        (Objects stored in the last hour are kept, in case a resize running
+        meanwhile hasn't recorded its version yet)
+        Return (versions dropped, bytes freed)
+    """
+
+    folderData = FolderData()
+    store, backupStore = folderData.store, folderData.backupStore
+    for folderPath in list(folderData.allFolderData):
+        folderData.import_legacy_backups(folderPath)
+    rows = store.backups()
+    objects = backupStore.objects()
+    now = time.time()
+    keep = sorted(
+        (
+            r for r in rows
+            if maxAge is None or now - r['time'] <= maxAge or r['version'] == ORIGINAL_VERSION
+        ),
+        # Dropped from the front: later versions oldest first, then originals
+        key = lambda r: (r['version'] == ORIGINAL_VERSION, r['time']),
+    )
+    if maxSize is not None:
+        refs = {}
+        for r in keep:
+            refs[r['hash']] = refs.get(r['hash'], 0) + 1
+        total = sum(objects.get(digest, 0) for digest in refs)
+        while keep and total > maxSize:
+            digest = keep.pop(0)['hash']
+            refs[digest] -= 1
+            if not refs[digest]:
+                total -= objects.get(digest, 0)
+    kept = {(r['uid'], r['name'], r['version']) for r in keep}
+    dropped = [key for key in ((r['uid'], r['name'], r['version']) for r in rows) if key not in kept]
+    store.delete_backups(dropped)
+    live = {r['hash'] for r in keep}
+    freed = 0
+    for digest, size in objects.items():
+        if digest in live:
+            continue
+        if now - os.stat(backupStore.object_path(digest)).st_ctime < 60*60:
+            continue
+        backupStore.remove(digest)
+        freed += size
+    backupStore.remove_stale_tmp()
+    print(
+        f'Dropped { len(dropped) } of { len(rows) } backup versions, '
+        f'freed { freed/1e6:.1f} MB; '
+        f'{ (sum(objects.values()) - freed)/1e6:.1f} MB kept'
+    )
+    return len(dropped), freed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Image browser and editor')
+    commands = parser.add_subparsers(dest='command')
+    prebuildParser = commands.add_parser(
+        'prebuild', help='make thumbnails for galleries without opening a window',
+    )
+    parser.add_argument(
+        '--thumb-packs', action='store_true',
+        help='keep each folder\'s thumbnails in one memory-mapped pack file',
+    )
+    parser.add_argument(
+        '--workers', type=int, default=None, dest='windowWorkers', metavar='N',
+        help='worker processes for the gallery\'s thumbnails and resizes (default: one per CPU)',
+    )
+    parser.add_argument(
+        '--stats', default=None, metavar='FILE',
+        help='collect timings and counters and write them to FILE (JSON) on exit',
+    )
+    prebuildParser.add_argument('folders', nargs='+', metavar='DIR')
+    prebuildParser.add_argument(
+        '--workers', type=int, default=None, help='worker processes (default: one per CPU)',
+    )
+    prebuildParser.add_argument(
+        '--sizes', default=WindowManager.thumbSize,
+        help=f'thumb sizes to make, out of { ",".join(THUMBNAIL_SIZES) } '
+            f'(default: { WindowManager.thumbSize }, the gallery\'s default)',
+    )
+    backupsParser = commands.add_parser(
+        'backups', help='list, restore and garbage collect backups of resized images',
+    )
+    backupCommands = backupsParser.add_subparsers(dest='backupCommand', required=True)
+    listParser = backupCommands.add_parser('list', help='show backup versions')
+    listParser.add_argument('folder', metavar='DIR')
+    listParser.add_argument('images', nargs='*', metavar='IMAGE')
+    restoreParser = backupCommands.add_parser(
+        'restore', help='put a backup version back (the current file is kept as a version)',
+    )
+    restoreParser.add_argument('folder', metavar='DIR')
+    restoreParser.add_argument('images', nargs='+', metavar='IMAGE')
+    restoreParser.add_argument(
+        '--version', type=int, default=None, help='version to restore (default: the original)',
+    )
+    gcParser = backupCommands.add_parser('gc', help='drop old versions and unused backups')
+    gcParser.add_argument(
+        '--max-age', type=float, default=None, metavar='DAYS',
+        help='drop versions older than this',
+    )
+    gcParser.add_argument(
+        '--max-size', type=float, default=None, metavar='MB',
+        help='then drop the oldest versions until backups take at most this',
+    )
+    args = parser.parse_args(argv)
+    perfStats.enabled = bool(args.stats)
+    FolderData.thumbPacks = args.thumb_packs
+
+    try:
+        if args.command == 'prebuild':
+            sizes = tuple(s for s in THUMBNAIL_SIZES if s in args.sizes.split(','))
+            unknown = set(args.sizes.split(',')) - set(THUMBNAIL_SIZES)
+            if unknown or not sizes:
+                parser.error(f'unknown thumb sizes: { args.sizes }')
+            prebuild(args.folders, numWorkers=args.workers, sizes=sizes)
+            return
+        if args.command == 'backups':
+            if args.backupCommand == 'list':
+                list_backups(args.folder, args.images)
+            elif args.backupCommand == 'restore':
+                restore_backups(args.folder, args.images, args.version)
+            else:
+                collect_backups(
+                    maxAge = None if args.max_age is None else args.max_age*24*60*60,
+                    maxSize = None if args.max_size is None else args.max_size*1e6,
+                )
+            return
+        WindowManager.thumbWorkers = WindowManager.resizeWorkers = args.windowWorkers
+        wm = WindowManager()
+        wm.run_window()
+        wm.stop_watching()
+        if wm.thumbJobs:
+            wm.thumbJobs.stop()
+        if wm.previewLoader:
+            wm.previewLoader.stop()
+        wm.thumbEngine.close()
+        wm.resizeEngine.close()
+        wm.previewEngine.close()
+    finally:
+        if args.stats:
+            perfStats.dump(args.stats)
+            print(perfStats.report())
+
+
 if __name__ == '__main__':
-    wm = WindowManager()
-    wm.run_window()
\ No newline at end of file
+    main()
\ No newline at end of file
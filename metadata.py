@@ -0,0 +1,255 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from perfstats import perfStats
+
+
+class MetadataStore():
+    """ SQLite (WAL mode) store for folder and per-image metadata
+
+        The folders table is the registry of every folder seen (path -> uid);
+        image rows are keyed by (uid, name) and loaded one folder at a time
+        Folder rows are written when a folder is first opened; image field
+        changes (eg ratings) are queued and written in small batches, so the
+        cost of a save is proportional to what changed
+    """
+
+    folderColumns = ('path', 'uid', 'thumbnailFolder', 'backupsFolder', 'shortName')
+    imageColumns = {
+        'path': 'TEXT',
+        'rating': 'INTEGER NOT NULL DEFAULT -1',
+        'dhash': 'TEXT', # hex perceptual hash
+        'width': 'INTEGER',
+        'height': 'INTEGER',
+        'captureTime': 'TEXT', # EXIF 'YYYY:MM:DD HH:MM:SS'
+        'sharpness': 'REAL', # quality metrics of the thumbnail
+        'brightness': 'REAL',
+        'clipped': 'REAL',
+        'contrast': 'INTEGER',
+        'infoMtime': 'INTEGER', # source mtime the above were read from
+    }
+    flushEvery = 64 # pending image updates
+    flushInterval = 0.5 # seconds
+
+    def __init__(self, dbPath):
+        self.dbPath = dbPath
+        self.lock = threading.RLock()
+        self.pending = {}
+        self.lastFlush = time.monotonic()
+        os.makedirs(os.path.dirname(dbPath) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(dbPath, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.create_tables()
+
+    def create_tables(self):
+        with self.lock, self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS folders ('
+                ' path TEXT PRIMARY KEY, uid TEXT UNIQUE NOT NULL,'
+                ' thumbnailFolder TEXT, backupsFolder TEXT, shortName TEXT)'
+            )
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS images ('
+                ' uid TEXT NOT NULL, name TEXT NOT NULL,'
+                ' PRIMARY KEY (uid, name)) WITHOUT ROWID'
+            )
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)'
+            )
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS backups ('
+                ' uid TEXT NOT NULL, name TEXT NOT NULL, version INTEGER NOT NULL,'
+                ' hash TEXT NOT NULL, size INTEGER, mtime INTEGER, time REAL,'
+                ' PRIMARY KEY (uid, name, version)) WITHOUT ROWID'
+            )
+            # Last backup version given to each image, kept when its versions
+            # are dropped, so a version number is never reused
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS backupVersions ('
+                ' uid TEXT NOT NULL, name TEXT NOT NULL, version INTEGER NOT NULL,'
+                ' PRIMARY KEY (uid, name)) WITHOUT ROWID'
+            )
+            existing = {
+                row[1] for row in self.conn.execute('PRAGMA table_info(images)')
+            }
+            for column, decl in self.imageColumns.items():
+                if column not in existing:
+                    self.conn.execute(f'ALTER TABLE images ADD COLUMN { column } { decl }')
+
+    def get_meta(self, key, default=None):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT value FROM meta WHERE key = ?', (key,)
+            ).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_meta(self, key, value):
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                (key, json.dumps(value)),
+            )
+
+    def load_folders(self):
+        """ Return dict {folderPath: folderData} of every stored folder,
+            without imageData (see load_images), so the cost doesn't grow
+            with the number of images ever seen
+        """
+
+        with self.lock:
+            return {
+                row[0]: dict(zip(self.folderColumns, row))
+                for row in self.conn.execute(
+                    f'SELECT { ", ".join(self.folderColumns) } FROM folders'
+                )
+            }
+
+    def load_images(self, uid):
+        """ Return dict {name: imageData} of one folder's images """
+
+        self.flush() # include queued updates
+        columns = ('name',) + tuple(self.imageColumns)
+        with self.lock:
+            return {
+                row[0]: dict(zip(columns, row))
+                for row in self.conn.execute(
+                    f'SELECT { ", ".join(columns) } FROM images WHERE uid = ?', (uid,)
+                )
+            }
+
+    def save_folder(self, folderData):
+        """ Write folder row and all its image rows """
+
+        with self.lock, self.conn, perfStats.timer('metadata.save_folder'):
+            self.conn.execute(
+                f'INSERT OR REPLACE INTO folders ({ ", ".join(self.folderColumns) })'
+                f' VALUES ({ ", ".join("?" for _ in self.folderColumns) })',
+                tuple(folderData[c] for c in self.folderColumns),
+            )
+            self.write_images(folderData['uid'], folderData['imageData'].values())
+
+    def write_images(self, uid, imageDatas):
+        columns = ('uid', 'name') + tuple(self.imageColumns)
+        self.conn.executemany(
+            f'INSERT OR REPLACE INTO images ({ ", ".join(columns) })'
+            f' VALUES ({ ", ".join("?" for _ in columns) })',
+            [
+                (uid, imageData['name']) + tuple(imageData.get(c) for c in self.imageColumns)
+                for imageData in imageDatas
+            ],
+        )
+
+    def update_image(self, uid, name, **fields):
+        """ Queue field updates for one image; written on the next flush """
+
+        with self.lock:
+            self.pending.setdefault((uid, name), {}).update(fields)
+            if len(self.pending) >= self.flushEvery:
+                self.flush()
+
+    def flush_if_due(self):
+        if self.pending and time.monotonic() - self.lastFlush >= self.flushInterval:
+            self.flush()
+
+    def flush(self):
+        """ Write all queued image updates in one transaction """
+
+        with self.lock:
+            self.lastFlush = time.monotonic()
+            if not self.pending:
+                return
+            pending, self.pending = self.pending, {}
+            perfStats.observe('metadata.flush_rows', len(pending))
+            byColumns = {}
+            for (uid, name), fields in pending.items():
+                columns = tuple(sorted(fields))
+                byColumns.setdefault(columns, []).append(
+                    (uid, name) + tuple(fields[c] for c in columns)
+                )
+            with self.conn, perfStats.timer('metadata.flush'):
+                for columns, rows in byColumns.items():
+                    self.conn.executemany(
+                        f'INSERT INTO images (uid, name, { ", ".join(columns) })'
+                        f' VALUES (?, ?, { ", ".join("?" for _ in columns) })'
+                        f' ON CONFLICT (uid, name) DO UPDATE SET'
+                        f' { ", ".join(f"{ c } = excluded.{ c }" for c in columns) }',
+                        rows,
+                    )
+
+    def add_backup(self, uid, name, digest, stat, backupTime):
+        """ Record a backup of image name as it was at stat (size, mtime),
+            stored under digest (see BackupStore); Return its version number
+            (1 only for the image's first backup, ie its original, even
+            after all its versions were dropped)
+        """
+
+        with self.lock, self.conn:
+            (last,) = self.conn.execute(
+                'SELECT MAX(version) FROM ('
+                ' SELECT version FROM backups WHERE uid = ? AND name = ?'
+                ' UNION ALL SELECT version FROM backupVersions WHERE uid = ? AND name = ?)',
+                (uid, name, uid, name),
+            ).fetchone()
+            version = (last or 0) + 1
+            self.conn.execute(
+                'INSERT INTO backups (uid, name, version, hash, size, mtime, time)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (uid, name, version, digest, *stat, backupTime),
+            )
+            self.conn.execute(
+                'INSERT OR REPLACE INTO backupVersions (uid, name, version) VALUES (?, ?, ?)',
+                (uid, name, version),
+            )
+        return version
+
+    def backups(self, uid=None, name=None):
+        """ Return list of backup rows (dicts) of one image, one folder or
+            all folders, in version order
+        """
+
+        columns = ('uid', 'name', 'version', 'hash', 'size', 'mtime', 'time')
+        where = [(c, v) for c, v in (('uid', uid), ('name', name)) if v is not None]
+        query = f'SELECT { ", ".join(columns) } FROM backups'
+        if where:
+            query += ' WHERE ' + ' AND '.join(f'{ c } = ?' for c, _ in where)
+        with self.lock:
+            return [
+                dict(zip(columns, row))
+                for row in self.conn.execute(
+                    query + ' ORDER BY uid, name, version', tuple(v for _, v in where)
+                )
+            ]
+
+    def delete_backups(self, keys):
+        """ Forget backup versions, given as (uid, name, version) """
+
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'DELETE FROM backups WHERE uid = ? AND name = ? AND version = ?', keys
+            )
+
+    def migrate_json(self, jsonPath):
+        """ Import an all_folder_data.json file once;
+            Return True if anything was imported
+        """
+
+        if self.get_meta('migratedJson'):
+            return False
+        try:
+            with open(jsonPath, encoding='utf-8') as file:
+                allFolderData = json.load(file)
+        except FileNotFoundError:
+            allFolderData = {}
+        with self.lock, self.conn:
+            for folderData in allFolderData.values():
+                self.save_folder(folderData)
+            self.set_meta('migratedJson', True)
+        return bool(allFolderData)
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.conn.close()
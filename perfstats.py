@@ -0,0 +1,176 @@
+import json
+import time
+import threading
+
+
+class Histogram():
+    """ Count, total, min, max and power-of-two buckets of observed values """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = {}
+
+    def add(self, value, scale):
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        bucket = int(value*scale).bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def merge(self, data):
+        self.count += data['count']
+        self.total += data['total']
+        for bound, pick in (('min', min), ('max', max)):
+            if data[bound] is not None:
+                old = getattr(self, bound)
+                setattr(self, bound, data[bound] if old is None else pick(old, data[bound]))
+        for bucket, n in data['buckets'].items():
+            bucket = int(bucket)
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + n
+
+    def percentile(self, p, scale):
+        """ Return upper bound of the bucket holding the p-th percentile """
+
+        target = p*self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= target:
+                return min((2**bucket)/scale, self.max)
+        return self.max
+
+    def to_dict(self, scale):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total/self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(0.5, scale),
+            'p95': self.percentile(0.95, scale),
+            'buckets': dict(self.buckets),
+        }
+
+
+class Timer():
+    """ Context manager adding elapsed seconds to a timing histogram """
+
+    __slots__ = ('stats', 'name', 'start')
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter() if self.stats.enabled else None
+        return self
+
+    def __exit__(self, *exc):
+        if self.start is not None:
+            self.stats.observe_time(self.name, time.perf_counter() - self.start)
+
+
+class Stats():
+    """ Process-wide counters and histograms for the hot paths
+
+        Off by default: every call returns at once until enabled is set
+        Worker processes ship their stats back with each job (see drain,
+        merge), so one Stats holds the whole pipeline
+    """
+
+    timeScale = 1e6 # time buckets are powers of two microseconds
+    valueScale = 1
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        self.timings = {}
+        self.values = {}
+
+    def incr(self, name, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def timer(self, name):
+        return Timer(self, name)
+
+    def observe_time(self, name, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.timings.setdefault(name, Histogram()).add(seconds, self.timeScale)
+
+    def observe(self, name, value):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.values.setdefault(name, Histogram()).add(value, self.valueScale)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'timings': {
+                    name: h.to_dict(self.timeScale) for name, h in self.timings.items()
+                },
+                'values': {
+                    name: h.to_dict(self.valueScale) for name, h in self.values.items()
+                },
+            }
+
+    def drain(self):
+        """ Return snapshot and reset (eg to ship from a worker process) """
+
+        data = self.snapshot()
+        with self.lock:
+            self.reset()
+        return data
+
+    def merge(self, data):
+        if not data:
+            return
+        with self.lock:
+            for name, n in data['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            for kind, histograms in (('timings', self.timings), ('values', self.values)):
+                for name, h in data[kind].items():
+                    histograms.setdefault(name, Histogram()).merge(h)
+
+    def dump(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+    def report(self):
+        """ Return stats as readable text """
+
+        if not self.enabled:
+            return 'Stats are off (start the gallery with --stats FILE to collect them)'
+        data = self.snapshot()
+        lines = ['Counters:']
+        lines += [f'  { name:32s} { n }' for name, n in sorted(data['counters'].items())]
+        lines += ['', 'Timings (ms): count, mean, p50, p95, max']
+        for name, h in sorted(data['timings'].items()):
+            lines.append(
+                f'  { name:32s} { h["count"]:7d} { 1000*h["mean"]:9.2f}'
+                f' { 1000*h["p50"]:9.2f} { 1000*h["p95"]:9.2f} { 1000*h["max"]:9.2f}'
+            )
+        lines += ['', 'Values: count, mean, p50, p95, max']
+        for name, h in sorted(data['values'].items()):
+            lines.append(
+                f'  { name:32s} { h["count"]:7d} { h["mean"]:9.1f}'
+                f' { h["p50"]:9.0f} { h["p95"]:9.0f} { h["max"]:9.0f}'
+            )
+        return '\n'.join(lines)
+
+
+perfStats = Stats()
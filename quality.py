@@ -0,0 +1,57 @@
+try:
+    import numpy as np
+except ImportError: # metrics are left unset
+    np = None
+
+
+QUALITY_SIZE = 400 # metrics are measured on images shrunk to fit this
+CLIP_LOW = 2 # luminance at or below this counts as crushed to black...
+CLIP_HIGH = 253 # ...and at or above this as blown to white
+METRICS = ('sharpness', 'brightness', 'clipped', 'contrast')
+
+
+def available():
+    return np is not None
+
+def quality_metrics(ims):
+    """ Return list of dicts {sharpness, brightness, clipped, contrast} for
+        a batch of PIL images ims (eg thumbnails), each measured with
+        whole-array NumPy operations
+        sharpness: variance of the Laplacian (blurry frames score low)
+        brightness: mean luminance, 0-255
+        clipped: fraction of pixels crushed to black or blown to white
+        contrast: spread of the middle 90% of the luminance histogram
+        (Return empty dicts if NumPy isn't installed)
+    """
+
+    if np is None:
+        return [{} for _ in ims]
+    # One image at a time: stacking the batch into one padded array
+    # measured slower, as per-image arrays stay in cache
+    return [image_metrics(im) for im in ims]
+
+def image_metrics(im):
+    if max(im.size) > QUALITY_SIZE: # same scale for every thumb size
+        im = im.copy()
+        im.thumbnail((QUALITY_SIZE, QUALITY_SIZE))
+    gray = np.asarray(im.convert('L'))
+    count = gray.size
+
+    # Brightness, clipping and contrast all come from the histogram
+    hist = np.bincount(gray.ravel(), minlength=256)
+    brightness = hist @ np.arange(256)/count
+    clipped = (hist[:CLIP_LOW + 1].sum() + hist[CLIP_HIGH:].sum())/count
+    cdf = hist.cumsum()/count
+    contrast = np.count_nonzero(cdf < 0.95) - np.count_nonzero(cdf < 0.05)
+
+    # 4-neighbour Laplacian of the interior
+    g = gray.astype(np.float32)
+    lap = 4*g[1:-1, 1:-1] - g[:-2, 1:-1] - g[2:, 1:-1] - g[1:-1, :-2] - g[1:-1, 2:]
+    sharpness = lap.var() if lap.size else 0.0
+
+    return {
+        'sharpness': round(float(sharpness), 1),
+        'brightness': round(float(brightness), 1),
+        'clipped': round(float(clipped), 4),
+        'contrast': int(contrast),
+    }
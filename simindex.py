@@ -0,0 +1,84 @@
+import itertools
+
+try:
+    popcount = int.bit_count # Python 3.10+
+except AttributeError:
+    popcount = lambda x: bin(x).count('1')
+
+
+class HashIndex():
+    """ Multi-index hash tables for finding perceptual hashes within a
+        Hamming distance without comparing against every hash
+
+        Hashes are split into numChunks chunks with one table per chunk; two
+        hashes within maxDistance differ in at most maxDistance//numChunks
+        bits of some chunk (pigeonhole), so a query only looks up its own
+        chunk values and their near variants. With the default
+        maxDistance + 1 chunks, that is an exact match on some chunk
+    """
+
+    def __init__(self, maxDistance, bits=64, numChunks=None):
+        self.maxDistance = maxDistance
+        numChunks = min(numChunks or maxDistance + 1, bits)
+        self.chunks = [] # (shift, mask)
+        self.probes = [] # xor masks of chunk values to look up
+        chunkRadius = maxDistance//numChunks
+        shift = 0
+        for i in range(numChunks):
+            width = (bits - shift)//(numChunks - i)
+            self.chunks.append((shift, (1 << width) - 1))
+            self.probes.append([
+                sum(1 << b for b in flipped)
+                for k in range(chunkRadius + 1)
+                for flipped in itertools.combinations(range(width), k)
+            ])
+            shift += width
+        self.tables = [{} for _ in self.chunks]
+
+    def add(self, h):
+        for table, (shift, mask) in zip(self.tables, self.chunks):
+            table.setdefault(h >> shift & mask, []).append(h)
+
+    def near(self, h):
+        """ Return set of indexed hashes within maxDistance of h """
+
+        found = set()
+        maxDistance = self.maxDistance
+        for table, (shift, mask), probes in zip(self.tables, self.chunks, self.probes):
+            chunk = h >> shift & mask
+            for probe in probes:
+                for other in table.get(chunk ^ probe, ()):
+                    if other not in found and popcount(h ^ other) <= maxDistance:
+                        found.add(other)
+        return found
+
+
+def group_similar(hashes, maxDistance):
+    """ Group items whose hashes are within maxDistance, chaining through
+        intermediate items (eg a slow pan in a burst ends up in one group)
+        hashes is {item: int hash}
+        Return list of groups (lists of items) with more than one item
+    """
+
+    byHash = {}
+    for item, h in hashes.items():
+        byHash.setdefault(h, []).append(item)
+    parent = {h: h for h in byHash}
+
+    def find(h):
+        while parent[h] != h:
+            parent[h] = parent[parent[h]]
+            h = parent[h]
+        return h
+
+    # Each hash is compared only against those indexed before it
+    index = HashIndex(maxDistance)
+    for h in byHash:
+        for other in index.near(h):
+            parent[find(other)] = find(h)
+        index.add(h)
+
+    groups = {}
+    for h, items in byHash.items():
+        groups.setdefault(find(h), []).extend(items)
+    return [items for items in groups.values() if len(items) > 1]
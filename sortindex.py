@@ -0,0 +1,124 @@
+import time
+import bisect
+import threading
+
+
+SORT_NAME = 'name'
+SORT_RATING = 'rating'
+SORT_CAPTURED = 'captured'
+SORT_MTIME = 'mtime'
+SORT_SIZE = 'size'
+SORT_PIXELS = 'pixels'
+SORT_SHARPNESS = 'sharpness'
+SORT_BRIGHTNESS = 'brightness'
+SORT_CLIPPED = 'clipped'
+SORT_CONTRAST = 'contrast'
+EXIF_TIME_FORMAT = '%Y:%m:%d %H:%M:%S'
+
+
+def captured_key(attrs):
+    """ EXIF capture time, falling back to file mtime in the same format """
+
+    if attrs.get('captureTime'):
+        return attrs['captureTime']
+    return time.strftime(EXIF_TIME_FORMAT, time.localtime((attrs.get('mtime') or 0)/1e9))
+
+def metric_key(attrs, metric, sign=1):
+    """ Quality metric, worst first with sign 1 (lowest first) or -1;
+        images not measured yet go last
+    """
+
+    value = attrs.get(metric)
+    return (value is None, sign*(value or 0))
+
+# Leading part of each sort key; the image name is appended to break ties
+SORT_KEYS = {
+    SORT_NAME: lambda attrs: (),
+    SORT_RATING: lambda attrs: (-attrs.get('rating', -1),),
+    SORT_CAPTURED: lambda attrs: (captured_key(attrs),),
+    SORT_MTIME: lambda attrs: (attrs.get('mtime') or 0,),
+    SORT_SIZE: lambda attrs: (attrs.get('size') or 0,),
+    SORT_PIXELS: lambda attrs: ((attrs.get('width') or 0)*(attrs.get('height') or 0),),
+    # Culling: blurriest, darkest, most clipped and flattest first
+    SORT_SHARPNESS: lambda attrs: metric_key(attrs, 'sharpness'),
+    SORT_BRIGHTNESS: lambda attrs: metric_key(attrs, 'brightness'),
+    SORT_CLIPPED: lambda attrs: metric_key(attrs, 'clipped', -1),
+    SORT_CONTRAST: lambda attrs: metric_key(attrs, 'contrast'),
+}
+
+
+class SortIndex():
+    """ Sorted orders of one folder's images on each sort key
+
+        Each order is a sorted list of (key..., name), built the first time
+        it is asked for and then kept up to date: changing an image's
+        attributes (eg its rating) moves it with a binary search in each
+        built order instead of re-sorting the folder
+    """
+
+    def __init__(self, attrs):
+        """ attrs is {img: {rating, mtime, size, width, height, captureTime,
+            and quality metrics}}
+        """
+
+        self.attrs = {img: dict(a) for img, a in attrs.items()}
+        self.orders = {}
+        self.lock = threading.Lock()
+
+    def sort_key(self, sortBy, img):
+        return SORT_KEYS[sortBy](self.attrs[img]) + (img,)
+
+    def order(self, sortBy):
+        """ Return list of images sorted by sortBy (a SORT_KEYS key) """
+
+        with self.lock:
+            keys = self.orders.get(sortBy)
+            if keys is None:
+                keys = sorted(self.sort_key(sortBy, img) for img in self.attrs)
+                self.orders[sortBy] = keys
+            return [key[-1] for key in keys]
+
+    def update(self, img, **fields):
+        """ Set attributes of img, adding it if new """
+
+        with self.lock:
+            if img not in self.attrs:
+                self.attrs[img] = dict(fields)
+                for sortBy, keys in self.orders.items():
+                    bisect.insort(keys, self.sort_key(sortBy, img))
+                return
+            oldKeys = {sortBy: self.sort_key(sortBy, img) for sortBy in self.orders}
+            self.attrs[img].update(fields)
+            for sortBy, keys in self.orders.items():
+                newKey = self.sort_key(sortBy, img)
+                if newKey != oldKeys[sortBy]:
+                    del keys[bisect.bisect_left(keys, oldKeys[sortBy])]
+                    bisect.insort(keys, newKey)
+
+    def remove(self, img):
+        with self.lock:
+            if img not in self.attrs:
+                return
+            for sortBy, keys in self.orders.items():
+                del keys[bisect.bisect_left(keys, self.sort_key(sortBy, img))]
+            del self.attrs[img]
+
+    def position(self, order, sortBy, img):
+        """ Return where img goes in order, a list of indexed images sorted
+            by sortBy (eg the gallery's, which isn't re-sorted as ratings
+            change, so it is searched rather than the index's own order)
+        """
+
+        with self.lock:
+            key = self.sort_key(sortBy, img)
+            lo, hi = 0, len(order)
+            while lo < hi:
+                mid = (lo + hi)//2
+                if self.sort_key(sortBy, order[mid]) < key:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return lo
+
+    def __contains__(self, img):
+        return img in self.attrs
@@ -0,0 +1,124 @@
+import os
+import time
+import pytest
+import gallery
+from gallery import FolderData, collect_backups, ORIGINAL_VERSION
+from backupstore import BackupStore
+
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return str(path)
+
+def replace(path, data):
+    # As the gallery edits images: objects may be hardlinks to them
+    os.replace(write(f'{ path }.tmp', data), path)
+
+def test_put_links_once_and_references_after(tmp_path):
+    store = BackupStore(str(tmp_path / 'store'))
+    image = write(tmp_path / 'a.jpg', b'original')
+    digest, stat, how = store.put(image)
+    assert how == 'linked'
+    assert os.path.samefile(store.object_path(digest), image)
+    assert stat == (os.stat(image).st_size, os.stat(image).st_mtime_ns)
+    # Same content from another image: stored once
+    other = write(tmp_path / 'b.jpg', b'original')
+    assert store.put(other) == (digest, (8, os.stat(other).st_mtime_ns), 'referenced')
+    assert store.objects() == {digest: 8}
+
+def test_put_known_version_skips_hashing(tmp_path, monkeypatch):
+    store = BackupStore(str(tmp_path / 'store'))
+    image = write(tmp_path / 'a.jpg', b'original')
+    digest, stat, _ = store.put(image)
+    monkeypatch.setattr(BackupStore, 'file_hash', classmethod(lambda cls, path: pytest.fail('hashed')))
+    assert store.put(image, (digest, *stat)) == (digest, stat, 'referenced')
+
+def test_restore_is_a_copy(tmp_path):
+    store = BackupStore(str(tmp_path / 'store'))
+    image = write(tmp_path / 'a.jpg', b'original')
+    digest, _, _ = store.put(image)
+    replace(image, b'resized')
+    store.restore(digest, image)
+    assert open(image, 'rb').read() == b'original'
+    write(image, b'edited in place')
+    assert open(store.object_path(digest), 'rb').read() == b'original'
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.tmp')]
+
+def test_remove_and_stale_tmp(tmp_path):
+    store = BackupStore(str(tmp_path / 'store'))
+    digest, _, _ = store.put(write(tmp_path / 'a.jpg', b'a'))
+    tmpPath = store.object_path(digest) + '.123.tmp'
+    write(tmpPath, b'interrupted')
+    store.remove_stale_tmp(age=24*60*60)
+    assert os.path.exists(tmpPath)
+    os.utime(tmpPath, (0, 0))
+    store.remove_stale_tmp(age=24*60*60)
+    assert not os.path.exists(tmpPath)
+    store.remove(digest)
+    assert not store.has(digest)
+    assert store.objects() == {}
+
+
+@pytest.fixture
+def folder_data(tmp_path, monkeypatch):
+    """ FolderData with its .metadata in tmp_path, and one gallery folder
+        photos with a.jpg edited twice after its original and b.jpg once
+    """
+
+    monkeypatch.chdir(tmp_path)
+    for attr in ('allFolderData', 'store', 'backupStore'):
+        monkeypatch.setattr(FolderData, attr, None)
+    folderData = FolderData()
+    path = str(tmp_path / 'photos').replace(os.sep, '/')
+    os.makedirs(path)
+    folderData.get_folder_data(path)
+    for img, contents in (('a.jpg', [b'a original', b'a v2', b'a v3']), ('b.jpg', [b'b original'])):
+        for data in contents:
+            replace(os.path.join(path, img), data)
+            folderData.backup_image(path, img)
+        replace(os.path.join(path, img), b'resized ' + data)
+    yield folderData, path
+    folderData.store.close()
+
+def versions(folderData, path, img):
+    return [row['version'] for row in folderData.backup_versions(path, img)]
+
+def test_gc_size_drops_later_versions_before_originals(folder_data):
+    folderData, path = folder_data
+    assert versions(folderData, path, 'a.jpg') == [1, 2, 3]
+    originals = sum(
+        row['size'] for img in ('a.jpg', 'b.jpg')
+        for row in folderData.backup_versions(path, img)[:1]
+    )
+    dropped, _ = collect_backups(maxSize=originals)
+    assert dropped == 2
+    assert versions(folderData, path, 'a.jpg') == [ORIGINAL_VERSION]
+    assert versions(folderData, path, 'b.jpg') == [ORIGINAL_VERSION]
+    version, _ = folderData.restore_image(path, 'a.jpg')
+    assert version == ORIGINAL_VERSION
+    assert open(os.path.join(path, 'a.jpg'), 'rb').read() == b'a original'
+
+def test_gc_age_keeps_originals(folder_data):
+    folderData, path = folder_data
+    collect_backups(maxAge=0)
+    assert versions(folderData, path, 'a.jpg') == [ORIGINAL_VERSION]
+    assert versions(folderData, path, 'b.jpg') == [ORIGINAL_VERSION]
+
+def test_gc_versions_are_not_reused(folder_data):
+    folderData, path = folder_data
+    collect_backups(maxSize=0) # drops everything
+    assert versions(folderData, path, 'a.jpg') == []
+    assert folderData.backup_image(path, 'a.jpg') == 4 # not a new "original"
+
+def test_gc_removes_unreferenced_objects_after_an_hour(folder_data, monkeypatch):
+    folderData, path = folder_data
+    stored = folderData.backupStore.objects()
+    collect_backups(maxAge=0)
+    assert folderData.backupStore.objects() == stored # too recent to remove
+    now = time.time()
+    monkeypatch.setattr(gallery.time, 'time', lambda: now + 2*60*60)
+    _, freed = collect_backups(maxAge=0)
+    live = {row['hash'] for img in ('a.jpg', 'b.jpg') for row in folderData.backup_versions(path, img)}
+    assert set(folderData.backupStore.objects()) == live
+    assert freed == sum(size for digest, size in stored.items() if digest not in live)
@@ -0,0 +1,74 @@
+import time
+import queue
+from gallery import (
+    UpdateDispatcher, ImageUpdateRecord, THUMB, PROGRESS, COPY_DONE, ADDED, REMOVED, MODIFIED,
+)
+
+
+def dispatcher(records, apply=None):
+    updateQueue = queue.SimpleQueue()
+    for record in records:
+        updateQueue.put((time.perf_counter(), record))
+    applied = []
+    return UpdateDispatcher(updateQueue, apply or applied.append), applied
+
+def test_repeated_thumb_updates_apply_once():
+    d, applied = dispatcher([
+        ImageUpdateRecord('a.jpg', '/f'), ImageUpdateRecord('b.jpg', '/f'),
+        ImageUpdateRecord('a.jpg', '/f'),
+    ])
+    assert d.dispatch('/f') == 2
+    assert [r.image for r in applied] == ['a.jpg', 'b.jpg']
+    assert not d.busy
+
+def test_only_latest_progress_applies():
+    d, applied = dispatcher([
+        ImageUpdateRecord('copy', '/f', PROGRESS, 'Copied 1/3'),
+        ImageUpdateRecord('copy', '/f', PROGRESS, 'Copied 2/3'),
+        ImageUpdateRecord('resize', '/f', PROGRESS, 'Resized 1/1'),
+    ])
+    d.dispatch('/f')
+    assert [(r.image, r.data) for r in applied] == [('copy', 'Copied 2/3'), ('resize', 'Resized 1/1')]
+
+def test_folder_changes_merge_to_net_effect():
+    changes = [
+        ('a.jpg', ADDED), ('a.jpg', MODIFIED), # new, then written: still new
+        ('b.jpg', ADDED), ('b.jpg', REMOVED), # came and went
+        ('c.jpg', REMOVED), ('c.jpg', ADDED), # replaced: read it again as new
+        ('d.jpg', MODIFIED), ('d.jpg', MODIFIED),
+    ]
+    d, applied = dispatcher([ImageUpdateRecord(img, '/f', kind) for img, kind in changes])
+    d.dispatch('/f')
+    assert sorted((r.image, r.kind) for r in applied) == [
+        ('a.jpg', ADDED), ('b.jpg', REMOVED), ('c.jpg', ADDED), ('d.jpg', MODIFIED),
+    ]
+
+def test_other_folders_dropped_except_reports():
+    results = {'a.jpg': 'copied', 'b.jpg': 'failed: disk full'}
+    d, applied = dispatcher([
+        ImageUpdateRecord('a.jpg', '/old'),
+        ImageUpdateRecord('a.jpg', '/old', MODIFIED),
+        ImageUpdateRecord('copy', '/old', COPY_DONE, results),
+        ImageUpdateRecord('b.jpg', '/new'),
+    ])
+    d.dispatch('/new')
+    assert [(r.image, r.kind) for r in applied] == [('copy', COPY_DONE), ('b.jpg', THUMB)]
+    assert applied[0].data == results
+
+def test_frame_budget_spreads_work_over_ticks():
+    applied = []
+
+    def slow_apply(record):
+        applied.append(record.image)
+        time.sleep(0.01)
+
+    d, _ = dispatcher(
+        [ImageUpdateRecord(f'{ i }.jpg', '/f') for i in range(10)], apply=slow_apply,
+    )
+    d.frameBudget = 0.025
+    first = d.dispatch('/f')
+    assert 1 <= first < 10
+    assert d.busy
+    while d.busy:
+        d.dispatch('/f')
+    assert applied == [f'{ i }.jpg' for i in range(10)] # in queue order
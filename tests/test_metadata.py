@@ -0,0 +1,44 @@
+import json
+from metadata import MetadataStore
+
+
+def folder_data(path, uid, images):
+    return {
+        'path': path, 'uid': uid, 'thumbnailFolder': f'.metadata/{ uid }',
+        'backupsFolder': f'{ path }/backups', 'shortName': path.rsplit('/', 1)[-1],
+        'imageData': {img: {'name': img, 'rating': rating} for img, rating in images.items()},
+    }
+
+def test_migrate_json_imports_once(tmp_path):
+    jsonPath = tmp_path / 'all_folder_data.json'
+    jsonPath.write_text(json.dumps({
+        '/photos/a': folder_data('/photos/a', 'uid-a', {'1.jpg': 3, '2.jpg': -1}),
+        '/photos/b': folder_data('/photos/b', 'uid-b', {}),
+    }), encoding='utf-8')
+    store = MetadataStore(str(tmp_path / 'metadata.db'))
+
+    assert store.migrate_json(str(jsonPath))
+    folders = store.load_folders()
+    assert set(folders) == {'/photos/a', '/photos/b'}
+    assert folders['/photos/a']['uid'] == 'uid-a'
+    assert 'imageData' not in folders['/photos/a']
+    images = store.load_images('uid-a')
+    assert {img: data['rating'] for img, data in images.items()} == {'1.jpg': 3, '2.jpg': -1}
+
+    # Not again, even if the JSON file is still there and has changed
+    store.update_image('uid-a', '1.jpg', rating=5)
+    assert not store.migrate_json(str(jsonPath))
+    assert store.load_images('uid-a')['1.jpg']['rating'] == 5
+    store.close()
+
+    store = MetadataStore(str(tmp_path / 'metadata.db'))
+    assert not store.migrate_json(str(jsonPath))
+    assert store.load_images('uid-a')['1.jpg']['rating'] == 5
+    store.close()
+
+def test_migrate_json_without_file(tmp_path):
+    store = MetadataStore(str(tmp_path / 'metadata.db'))
+    assert not store.migrate_json(str(tmp_path / 'missing.json'))
+    assert store.get_meta('migratedJson')
+    assert store.load_folders() == {}
+    store.close()
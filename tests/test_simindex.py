@@ -0,0 +1,67 @@
+import random
+from simindex import HashIndex, group_similar, popcount
+
+
+def brute_force_groups(hashes, maxDistance):
+    items = list(hashes)
+    parent = {item: item for item in items}
+
+    def find(item):
+        while parent[item] != item:
+            item = parent[item]
+        return item
+
+    for i, a in enumerate(items):
+        for b in items[i + 1:]:
+            if popcount(hashes[a] ^ hashes[b]) <= maxDistance:
+                parent[find(a)] = find(b)
+    groups = {}
+    for item in items:
+        groups.setdefault(find(item), []).append(item)
+    return [items for items in groups.values() if len(items) > 1]
+
+def canonical(groups):
+    return sorted(sorted(group) for group in groups)
+
+def flip_bits(rng, h, count):
+    for bit in rng.sample(range(64), count):
+        h ^= 1 << bit
+    return h
+
+def random_hashes(rng, numBursts, maxFlips):
+    """ Bursts of near hashes (a few bits apart, chaining) and lone ones """
+
+    hashes = {}
+    for burst in range(numBursts):
+        h = rng.getrandbits(64)
+        for shot in range(rng.randint(1, 6)):
+            hashes[f'{ burst }-{ shot }'] = h
+            h = flip_bits(rng, h, rng.randint(0, maxFlips))
+    return hashes
+
+def test_near_matches_brute_force():
+    rng = random.Random(1)
+    hashes = [rng.getrandbits(64) for _ in range(300)]
+    hashes += [flip_bits(rng, h, rng.randint(0, 12)) for h in hashes[:300]]
+    for maxDistance in (0, 4, 10):
+        index = HashIndex(maxDistance)
+        for h in hashes:
+            index.add(h)
+        for h in hashes[::7]:
+            assert index.near(h) == {
+                other for other in hashes if popcount(h ^ other) <= maxDistance
+            }
+
+def test_group_similar_matches_brute_force():
+    rng = random.Random(2)
+    for maxDistance in (0, 3, 10):
+        hashes = random_hashes(rng, numBursts=80, maxFlips=maxDistance + 2)
+        assert canonical(group_similar(hashes, maxDistance)) == \
+            canonical(brute_force_groups(hashes, maxDistance))
+
+def test_group_similar_chains_through_intermediates():
+    a = 0
+    b = a ^ 0b111 # 3 bits from a
+    c = b ^ 0b111000 # 3 bits from b, 6 from a
+    groups = group_similar({'a': a, 'b': b, 'c': c, 'far': (1 << 64) - 1}, 3)
+    assert canonical(groups) == [['a', 'b', 'c']]
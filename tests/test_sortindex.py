@@ -0,0 +1,49 @@
+import random
+from sortindex import SortIndex, SORT_KEYS, SORT_NAME, SORT_RATING, SORT_SIZE, SORT_SHARPNESS
+
+
+def full_sort(index, sortBy):
+    return sorted(index.attrs, key=lambda img: index.sort_key(sortBy, img))
+
+def test_order_ties_break_on_name():
+    index = SortIndex({'b': {'rating': 1}, 'a': {'rating': 1}, 'c': {'rating': 2}})
+    assert index.order(SORT_RATING) == ['c', 'a', 'b']
+    assert index.order(SORT_NAME) == ['a', 'b', 'c']
+
+def test_unmeasured_images_sort_last():
+    index = SortIndex({'a': {}, 'b': {'sharpness': 9.0}, 'c': {'sharpness': 1.5}})
+    assert index.order(SORT_SHARPNESS) == ['c', 'b', 'a']
+
+def test_update_and_remove_keep_built_orders_sorted():
+    rng = random.Random(6)
+    index = SortIndex({
+        f'{ i:03d}.jpg': {'rating': rng.randint(-1, 5), 'size': rng.randint(0, 10)}
+        for i in range(50)
+    })
+    for sortBy in SORT_KEYS:
+        index.order(sortBy)
+    for step in range(300):
+        img = f'{ rng.randrange(60):03d}.jpg'
+        if rng.random() < 0.2:
+            index.remove(img)
+        else:
+            index.update(img, rating=rng.randint(-1, 5), size=rng.randint(0, 10))
+        for sortBy in (SORT_NAME, SORT_RATING, SORT_SIZE):
+            assert index.order(sortBy) == full_sort(index, sortBy), (step, sortBy)
+    for sortBy in SORT_KEYS:
+        assert index.order(sortBy) == full_sort(index, sortBy)
+
+def test_remove_unknown_image_is_ignored():
+    index = SortIndex({'a': {'rating': 1}})
+    index.order(SORT_RATING)
+    index.remove('b')
+    assert index.order(SORT_RATING) == ['a']
+    assert 'b' not in index
+
+def test_position_in_order():
+    index = SortIndex({'a': {'rating': 1}, 'c': {'rating': 3}, 'd': {'rating': 0}})
+    order = index.order(SORT_RATING)
+    index.update('b', rating=2)
+    assert index.position(order, SORT_RATING, 'b') == 1
+    assert index.position(order, SORT_NAME, 'b') == 2
+    assert index.position([], SORT_RATING, 'b') == 0
@@ -0,0 +1,96 @@
+import os
+import json
+import threading
+from thumbindex import ThumbIndex, FRESH, STALE, MISSING
+from utils import image_stats
+
+
+def make_file(path, mtime):
+    with open(path, 'wb') as f:
+        f.write(b'x')
+    os.utime(path, (mtime, mtime))
+
+def make_folder(tmp_path):
+    src = tmp_path / 'photos'
+    thumbs = tmp_path / '.metadata' / 'uid' / 'thumbs'
+    src.mkdir()
+    thumbs.mkdir(parents=True)
+    return src, thumbs
+
+def test_bootstrap_trusts_thumbs_newer_than_source(tmp_path):
+    src, thumbs = make_folder(tmp_path)
+    make_file(src / 'a.jpg', 1000)
+    make_file(src / 'b.jpg', 3000)
+    make_file(src / 'c.jpg', 1000)
+    make_file(thumbs / 'S_a.png', 2000)
+    make_file(thumbs / 'M_a.png', 500) # made before a.jpg was edited
+    make_file(thumbs / 'S_b.png', 2000)
+    index = ThumbIndex(str(src), str(thumbs))
+    stats = image_stats(str(src), refresh=True)
+
+    assert index.classify(stats, 'S') == {'a.jpg': FRESH, 'b.jpg': MISSING, 'c.jpg': MISSING}
+    assert index.classify(stats, 'M') == {'a.jpg': MISSING, 'b.jpg': MISSING, 'c.jpg': MISSING}
+    assert index.dirty
+
+def test_classify_and_record(tmp_path):
+    src, thumbs = make_folder(tmp_path)
+    index = ThumbIndex(str(src), str(thumbs))
+    index.record('a.jpg', (10, 100), ['S'])
+    index.record('a.jpg', (10, 100), ['M']) # same version: sizes add up
+    assert index.classify({'a.jpg': (10, 100), 'b.jpg': (1, 1)}, 'S') == \
+        {'a.jpg': FRESH, 'b.jpg': MISSING}
+    assert index.status('a.jpg', (10, 100), 'M') == FRESH
+    assert index.status('a.jpg', (11, 100), 'S') == STALE
+    assert index.status('a.jpg', None, 'S') == STALE # source gone
+    index.record('a.jpg', (11, 200), ['S']) # new version: older sizes drop
+    assert index.status('a.jpg', (11, 200), 'S') == FRESH
+    assert index.status('a.jpg', (11, 200), 'M') == MISSING
+    index.forget('a.jpg')
+    assert index.status('a.jpg', (11, 200), 'S') == MISSING
+
+def test_save_and_reload(tmp_path):
+    src, thumbs = make_folder(tmp_path)
+    index = ThumbIndex(str(src), str(thumbs))
+    index.record('a.jpg', (10, 100), ['S', 'L'])
+    index.save()
+    assert not index.dirty
+    reloaded = ThumbIndex(str(src), str(thumbs))
+    assert reloaded.status('a.jpg', (10, 100), 'L') == FRESH
+    assert not reloaded.dirty
+
+def test_unreadable_index_is_rebuilt(tmp_path):
+    src, thumbs = make_folder(tmp_path)
+    make_file(src / 'a.jpg', 1000)
+    make_file(thumbs / 'S_a.png', 2000)
+    index = ThumbIndex(str(src), str(thumbs))
+    index.record('a.jpg', (1, 1000), ['L'])
+    index.save()
+    for content in (
+        json.dumps({'version': ThumbIndex.version + 1, 'entries': {}}),
+        '{"version": 1, "entr', # torn
+    ):
+        with open(index.path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        # Bootstrapped from the thumb files, not the saved entries
+        assert set(ThumbIndex(str(src), str(thumbs)).entries['a.jpg']['thumbs']) == {'S'}
+
+def test_concurrent_saves(tmp_path):
+    src, thumbs = make_folder(tmp_path)
+    index = ThumbIndex(str(src), str(thumbs))
+    errors = []
+
+    def work(n):
+        try:
+            for i in range(100):
+                index.record(f'{ n }_{ i }.jpg', (1, i), ['S'])
+                index.save()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=work, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert len(ThumbIndex(str(src), str(thumbs)).entries) == 400
@@ -0,0 +1,72 @@
+import os
+from thumbpack import ThumbPack
+
+
+def reopen(pack, folder):
+    pack.close()
+    return ThumbPack(str(folder))
+
+def test_get_checks_source_stat(tmp_path):
+    pack = ThumbPack(str(tmp_path))
+    pack.put('S', 'a.jpg', (10, 100), b'thumb a')
+    assert pack.get('S', 'a.jpg') == b'thumb a'
+    assert pack.get('S', 'a.jpg', (10, 100)) == b'thumb a'
+    assert pack.get('S', 'a.jpg', (10, 101)) is None
+    assert pack.get('M', 'a.jpg') is None
+    pack.close()
+
+def test_replay_after_torn_record(tmp_path):
+    pack = ThumbPack(str(tmp_path))
+    pack.put('S', 'a.jpg', (1, 1), b'aaaa')
+    pack.put('S', 'b.jpg', (2, 2), b'bbbb')
+    pack.close()
+    # A crash mid-append leaves part of the last index record
+    indexPath = os.path.join(tmp_path, ThumbPack.indexName)
+    with open(indexPath, 'r+b') as f:
+        f.truncate(os.path.getsize(indexPath) - 3)
+
+    pack = ThumbPack(str(tmp_path))
+    assert pack.get('S', 'a.jpg') == b'aaaa'
+    assert pack.get('S', 'b.jpg') is None
+    # Records appended after the torn one are replayed too
+    pack.put('S', 'c.jpg', (3, 3), b'cccc')
+    pack = reopen(pack, tmp_path)
+    assert pack.get('S', 'a.jpg') == b'aaaa'
+    assert pack.get('S', 'c.jpg', (3, 3)) == b'cccc'
+    pack.close()
+
+def test_index_of_another_pack_resets(tmp_path):
+    pack = ThumbPack(str(tmp_path))
+    pack.put('S', 'a.jpg', (1, 1), b'aaaa')
+    pack.close()
+    dataPath = os.path.join(tmp_path, ThumbPack.dataName)
+    with open(dataPath, 'r+b') as f:
+        f.seek(len(ThumbPack.magic))
+        f.write(b'\0'*16) # another pack id
+    pack = ThumbPack(str(tmp_path))
+    assert pack.get('S', 'a.jpg') is None
+    assert pack.entries == {}
+    pack.close()
+
+def test_compaction_keeps_live_thumbs(tmp_path):
+    pack = ThumbPack(str(tmp_path))
+    pack.put('S', 'a.jpg', (1, 1), b'old a')
+    pack.put('M', 'a.jpg', (1, 1), b'a at M')
+    pack.put('S', 'b.jpg', (2, 2), b'b')
+    pack.put('S', 'a.jpg', (1, 2), b'new a')
+    pack.forget('b.jpg')
+    assert pack.garbageBytes == len(b'old a') + len(b'b')
+    pack.get('S', 'a.jpg') # maps the data file before compaction
+    pack.compact()
+    assert pack.garbageBytes == 0
+    assert pack.get('S', 'a.jpg', (1, 2)) == b'new a'
+
+    pack.put('S', 'c.jpg', (3, 3), b'c')
+    pack = reopen(pack, tmp_path)
+    assert pack.get('S', 'a.jpg', (1, 2)) == b'new a'
+    assert pack.get('M', 'a.jpg', (1, 1)) == b'a at M'
+    assert pack.get('S', 'b.jpg') is None
+    assert pack.get('S', 'c.jpg') == b'c'
+    assert pack.garbageBytes == 0
+    assert not os.path.exists(os.path.join(tmp_path, ThumbPack.dataName + '.tmp'))
+    pack.close()
@@ -0,0 +1,60 @@
+import os
+import errno
+import utils
+from utils import copy_image_file
+
+
+def make_file(path, data, mtime=None):
+    with open(path, 'wb') as f:
+        f.write(data)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+    return str(path)
+
+def leftovers(folder):
+    return [name for name in os.listdir(folder) if name.endswith('.tmp')]
+
+def test_copy_keeps_content_and_mtime(tmp_path):
+    (tmp_path / 'dest').mkdir()
+    src = make_file(tmp_path / 'a.jpg', os.urandom(300*1024), mtime=1_500_000_000)
+    assert copy_image_file(src, str(tmp_path / 'dest')) == 'copied'
+    dst = tmp_path / 'dest' / 'a.jpg'
+    assert dst.read_bytes() == (tmp_path / 'a.jpg').read_bytes()
+    assert os.stat(dst).st_mtime == 1_500_000_000
+    assert leftovers(tmp_path / 'dest') == []
+
+def test_copy_skips_identical_file(tmp_path):
+    (tmp_path / 'dest').mkdir()
+    src = make_file(tmp_path / 'a.jpg', b'source', mtime=1_500_000_000)
+    # Same size, mtime within the window: taken as already copied
+    make_file(tmp_path / 'dest' / 'a.jpg', b'SOURCE', mtime=1_500_000_000.5)
+    assert copy_image_file(src, str(tmp_path / 'dest')) == 'skipped'
+    assert (tmp_path / 'dest' / 'a.jpg').read_bytes() == b'SOURCE'
+
+def test_copy_replaces_different_file(tmp_path):
+    (tmp_path / 'dest').mkdir()
+    src = make_file(tmp_path / 'a.jpg', b'new source', mtime=1_500_000_000)
+    make_file(tmp_path / 'dest' / 'a.jpg', b'old', mtime=1_500_000_000)
+    assert copy_image_file(src, str(tmp_path / 'dest')) == 'copied'
+    assert (tmp_path / 'dest' / 'a.jpg').read_bytes() == b'new source'
+
+def test_copy_falls_back_without_kernel_copy(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, 'kernel_copy', lambda srcFd, dstFd, size: False)
+    (tmp_path / 'dest').mkdir()
+    data = os.urandom(3*1024*1024 + 5)
+    src = make_file(tmp_path / 'a.jpg', data)
+    assert copy_image_file(src, str(tmp_path / 'dest')) == 'copied'
+    assert (tmp_path / 'dest' / 'a.jpg').read_bytes() == data
+    assert leftovers(tmp_path / 'dest') == []
+
+def test_kernel_copy_moves_on_from_unsupported_methods(tmp_path, monkeypatch):
+    def unsupported(*args):
+        raise OSError(errno.EXDEV, 'cross-device')
+    monkeypatch.setattr(utils, 'fcntl', None) # no reflink
+    if hasattr(os, 'copy_file_range'):
+        monkeypatch.setattr(os, 'copy_file_range', unsupported)
+    (tmp_path / 'dest').mkdir()
+    data = os.urandom(64*1024)
+    src = make_file(tmp_path / 'a.jpg', data)
+    assert copy_image_file(src, str(tmp_path / 'dest')) == 'copied'
+    assert (tmp_path / 'dest' / 'a.jpg').read_bytes() == data
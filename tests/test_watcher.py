@@ -0,0 +1,45 @@
+import os
+import queue
+from watcher import FolderWatcher, ADDED, REMOVED, MODIFIED
+
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def next_change(changes):
+    return changes.get(timeout=5)
+
+def test_polling_reports_added_modified_removed(tmp_path):
+    write(tmp_path / 'a.jpg', b'a')
+    changes = queue.Queue()
+    watcher = FolderWatcher(str(tmp_path), lambda kind, img: changes.put((kind, img)), usePolling=True)
+    watcher.pollInterval = 0.05
+    assert watcher.inotify is None
+    watcher.start()
+    try:
+        write(tmp_path / 'b.png', b'b')
+        write(tmp_path / 'notes.txt', b'not an image')
+        assert next_change(changes) == (ADDED, 'b.png')
+        write(tmp_path / 'a.jpg', b'a, edited')
+        assert next_change(changes) == (MODIFIED, 'a.jpg')
+        os.remove(tmp_path / 'b.png')
+        assert next_change(changes) == (REMOVED, 'b.png')
+    finally:
+        watcher.stop()
+        watcher.join(5)
+    assert changes.empty()
+    assert set(watcher.known) == {'a.jpg'}
+
+def test_apply_scan_reports_only_differences(tmp_path):
+    write(tmp_path / 'a.jpg', b'a')
+    write(tmp_path / 'b.jpg', b'b')
+    changes = []
+    watcher = FolderWatcher(str(tmp_path), lambda kind, img: changes.append((kind, img)), usePolling=True)
+    known = dict(watcher.known)
+    watcher.apply_scan(known)
+    assert changes == []
+    stats = {'a.jpg': known['a.jpg'], 'c.jpg': (1, 1)}
+    stats['a.jpg'] = (known['a.jpg'][0] + 1, known['a.jpg'][1])
+    watcher.apply_scan(stats)
+    assert sorted(changes) == [(ADDED, 'c.jpg'), (MODIFIED, 'a.jpg'), (REMOVED, 'b.jpg')]
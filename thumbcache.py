@@ -0,0 +1,58 @@
+import threading
+from collections import OrderedDict
+from perfstats import perfStats
+
+
+class ThumbCache():
+    """ Process-wide LRU cache of encoded thumbnail bytes, bounded by a
+        total byte budget
+
+        Keys are (folder uid, image, thumb size, source mtime), so an edited
+        source never hits a stale thumb; old entries just age out
+    """
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.numBytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(uid, image, thumbSize, stat):
+        """ Return cache key for image's thumb, given source (size, mtime) """
+
+        return (uid, image, thumbSize, stat[1])
+
+    def get(self, key):
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+        perfStats.incr('thumbcache.hit' if data is not None else 'thumbcache.miss')
+        return data
+
+    def put(self, key, data):
+        if len(data) > self.maxBytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.numBytes -= len(old)
+            self.entries[key] = data
+            self.numBytes += len(data)
+            while self.numBytes > self.maxBytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.numBytes -= len(evicted)
+                perfStats.incr('thumbcache.evicted')
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.numBytes = 0
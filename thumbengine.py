@@ -0,0 +1,157 @@
+import os
+import threading
+import multiprocessing
+import concurrent.futures
+from utils import thumbnails, LARGE_IMAGE_PIXELS
+from perfstats import perfStats
+
+
+def run_job(job):
+    """ Worker side of a pool job: Return (func(args), worker stats) """
+
+    func, args, collectStats = job
+    perfStats.enabled = collectStats
+    result = func(args)
+    return result, perfStats.drain() if collectStats else None
+
+
+class ThumbEngine():
+    """ Make thumbnails on a pool of worker processes
+
+        Results are streamed to a callback as each one completes, and at most
+        maxInFlight jobs are queued on the pool at any time, so memory stays
+        flat however many images a folder holds
+
+        Jobs can also be weighed by the pixels they decode (see run): those
+        in flight are kept within pixelBudget, workerPixels per worker, so
+        a few huge images can't exhaust memory together
+    """
+
+    workerPixels = LARGE_IMAGE_PIXELS
+    pollInterval = 0.5 # seconds between checks for jobs cancelled by close()
+
+    def __init__(self, numWorkers=None, maxInFlight=None, pixelBudget=None):
+        self.numWorkers = numWorkers or os.cpu_count() or 1
+        self.maxInFlight = maxInFlight or 2*self.numWorkers
+        self.pixelBudget = pixelBudget or self.numWorkers*self.workerPixels
+        self.executor = None
+        self.futures = set() # submitted and not yet reported, for close()
+        self.lock = threading.Lock()
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = concurrent.futures.ProcessPoolExecutor(
+                    self.numWorkers, mp_context=self.pool_context(),
+                )
+            return self.executor
+
+    @staticmethod
+    def pool_context():
+        """ Start workers with forkserver where available, else spawn: the
+            pool is made while other threads (GUI, watcher, copies) run, and
+            a worker forked from one of them could inherit a lock held at
+            that moment (eg perfStats') and block on it for good
+        """
+
+        methods = multiprocessing.get_all_start_methods()
+        return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+    def run(self, jobs, onDone, stopEvent=None, func=thumbnails, cost=None):
+        """ Run func(args) for each (key, args) in jobs;
+            call onDone(key, result, error) in this thread as each completes
+            Block until all submitted jobs are done
+            (Stop submitting new jobs once stopEvent is set)
+            cost(args), if given, estimates the pixels a job decodes; a job
+            waits while it would take those in flight over pixelBudget, and
+            one over budget by itself waits for the pool to be idle
+        """
+
+        if self.numWorkers <= 1:
+            return self.run_inline(jobs, onDone, stopEvent, func)
+        executor = self.get_executor()
+        pending = {} # {future: (key, pixels)}
+        inFlightPixels = 0
+        for key, args in jobs:
+            if stopEvent and stopEvent.is_set():
+                break
+            pixels = cost(args) if cost else 0
+            if pending and inFlightPixels + pixels > self.pixelBudget:
+                perfStats.incr('engine.held')
+            while pending and (
+                len(pending) >= self.maxInFlight
+                or inFlightPixels + pixels > self.pixelBudget
+            ):
+                inFlightPixels -= self.wait_some(pending, onDone)
+            job = (func, args, perfStats.enabled)
+            try:
+                future = executor.submit(run_job, job)
+            except RuntimeError: # closed meanwhile
+                perfStats.incr('engine.failed')
+                onDone(key, None, concurrent.futures.CancelledError())
+                break
+            pending[future] = (key, pixels)
+            with self.lock:
+                self.futures.add(future)
+            inFlightPixels += pixels
+        while pending:
+            self.wait_some(pending, onDone)
+
+    def wait_some(self, pending, onDone):
+        """ Wait for at least one pending job; Return pixels freed """
+
+        done = None
+        while not done:
+            # Jobs cancelled by close() may not wake wait(), so poll for them
+            done = {future for future in pending if future.cancelled()}
+            if not done:
+                done, _ = concurrent.futures.wait(
+                    pending, timeout=self.pollInterval,
+                    return_when=concurrent.futures.FIRST_COMPLETED,
+                )
+        with self.lock:
+            self.futures.difference_update(done)
+        freed = 0
+        for future in done:
+            key, pixels = pending.pop(future)
+            freed += pixels
+            if future.cancelled(): # eg by close(): reported as failed
+                error = concurrent.futures.CancelledError()
+            else:
+                error = future.exception()
+            if error:
+                perfStats.incr('engine.failed')
+                onDone(key, None, error)
+            else:
+                result, workerStats = future.result()
+                perfStats.merge(workerStats)
+                perfStats.incr('engine.done')
+                onDone(key, result, None)
+        return freed
+
+    def run_inline(self, jobs, onDone, stopEvent, func):
+        for key, args in jobs:
+            if stopEvent and stopEvent.is_set():
+                break
+            try:
+                result = func(args)
+            except Exception as e:
+                onDone(key, None, e)
+            else:
+                onDone(key, result, None)
+
+    def close(self):
+        """ Shut the pool down, dropping queued jobs; waits for the
+            workers, since exiting with them still running can make
+            the executor's management thread fail on closed pipes
+        """
+
+        with self.lock:
+            executor, self.executor = self.executor, None
+            futures, self.futures = self.futures, set()
+        # By hand rather than shutdown(cancel_futures=True), which needs
+        # Python 3.9; jobs already running can't be cancelled and finish
+        for future in futures:
+            future.cancel()
+        if executor is not None:
+            executor.shutdown(wait=True)
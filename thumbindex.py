@@ -0,0 +1,122 @@
+import os
+import json
+import threading
+from utils import image_stats
+
+
+FRESH = 'fresh'
+STALE = 'stale'
+MISSING = 'missing'
+
+
+class ThumbIndex():
+    """ Persistent per-folder record of which thumbnails were made from
+        which version of each source image
+
+        Entries are keyed by image filename and hold the source (size, mtime)
+        the thumbnails were made from, plus the thumb sizes made, so freshness
+        is decided from directory scan data alone (no image opens)
+    """
+
+    fileName = 'thumb_index.json'
+    version = 1
+
+    def __init__(self, folderPath, thumbnailFolder):
+        self.folderPath = folderPath
+        self.thumbnailFolder = thumbnailFolder
+        self.path = os.path.join(os.path.dirname(thumbnailFolder), self.fileName)
+        self.entries = None
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.saveLock = threading.Lock() # one save at a time, without blocking record()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as file:
+                data = json.load(file)
+        except (FileNotFoundError, ValueError):
+            data = None
+        if data and data.get('version') == self.version:
+            self.entries = data['entries']
+        else:
+            self.entries = self.bootstrap()
+            self.dirty = bool(self.entries)
+
+    def bootstrap(self):
+        """ Build entries for thumbnails made before the index existed:
+            trust a thumb if it is newer than its source
+            (one scan of each folder, no image opens)
+        """
+
+        entries = {}
+        if not os.path.isdir(self.thumbnailFolder):
+            return entries
+        thumbMtimes = {}
+        with os.scandir(self.thumbnailFolder) as thumbEntries:
+            for entry in thumbEntries:
+                prefix, _, stem = entry.name.partition('_')
+                stem = os.path.splitext(stem)[0]
+                thumbMtimes.setdefault(stem, {})[prefix] = entry.stat().st_mtime_ns
+        for img, (size, mtime) in image_stats(self.folderPath).items():
+            made = thumbMtimes.get(os.path.splitext(img)[0], {})
+            sizes = [prefix for prefix, tmtime in made.items() if tmtime >= mtime]
+            if sizes:
+                entries[img] = {'size': size, 'mtime': mtime, 'thumbs': sizes}
+        return entries
+
+    def status(self, img, stat, thumbSize):
+        """ Return FRESH, STALE or MISSING for img given its (size, mtime) """
+
+        entry = self.entries.get(img)
+        if entry is None or thumbSize not in entry['thumbs']:
+            return MISSING
+        if stat is None or (entry['size'], entry['mtime']) != tuple(stat):
+            return STALE
+        return FRESH
+
+    def classify(self, stats, thumbSize):
+        """ Return dict {img: status} for every image in stats """
+
+        return {
+            img: self.status(img, stat, thumbSize)
+            for img, stat in stats.items()
+        }
+
+    def record(self, img, stat, thumbSizes):
+        """ Note that thumbSizes were just made from img at stat (size, mtime) """
+
+        size, mtime = stat
+        thumbSizes = list(thumbSizes)
+        with self.lock:
+            old = self.entries.get(img)
+            if old and (old['size'], old['mtime']) == (size, mtime):
+                thumbSizes += [s for s in old['thumbs'] if s not in thumbSizes]
+            self.entries[img] = {
+                'size': size, 'mtime': mtime, 'thumbs': thumbSizes,
+            }
+            self.dirty = True
+
+    def forget(self, img):
+        with self.lock:
+            if self.entries.pop(img, None) is not None:
+                self.dirty = True
+
+    def save(self):
+        """ Write index atomically, if anything changed
+            (Saved from several threads, eg the thumb job manager and a
+            resize: each save snapshots, writes and replaces in turn, so
+            the shared temp file isn't written twice at once and a newer
+            snapshot is never replaced by an older one)
+        """
+
+        with self.saveLock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                data = {'version': self.version, 'entries': dict(self.entries)}
+                self.dirty = False
+            tmpPath = self.path + '.tmp'
+            with open(tmpPath, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmpPath, self.path)
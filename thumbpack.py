@@ -0,0 +1,223 @@
+import os
+import mmap
+import uuid
+import struct
+import threading
+
+
+O_BINARY = getattr(os, 'O_BINARY', 0) # Windows
+
+
+class ThumbPack():
+    """ One folder's thumbnails in a single append-only data file, with an
+        append-only index log of where each thumb is
+
+        Readers map the data file and copy thumbs out of the mapping, so
+        showing a page of thumbs costs no file opens or reads (the copy is
+        what PhotoImage wants, and stays valid when the pack is remapped or
+        compacted). A remade thumb is appended and
+        its old bytes become garbage until compact()
+        Both files start with the same pack id, so a data file and index
+        that don't belong together (eg after a crash mid-compaction) are
+        detected and the pack starts over (thumbs are a cache)
+    """
+
+    dataName = 'thumbs.pack'
+    indexName = 'thumbs.idx'
+    header = struct.Struct('<8s16s') # magic, pack id
+    magic = b'GALPACK1'
+    # offset, length, source size, source mtime, key length; then the key
+    # (thumb size prefix + '_' + image name, UTF-8); length 0 forgets the key
+    record = struct.Struct('<QIqqH')
+    compactRatio = 0.5 # compact when this much of the data file is garbage...
+    compactMinBytes = 16*1024*1024 # ...and at least this much
+
+    def __init__(self, folder):
+        self.dataPath = os.path.join(folder, self.dataName)
+        self.indexPath = os.path.join(folder, self.indexName)
+        self.lock = threading.Lock()
+        self.entries = {} # {(prefix, img): (offset, length, (size, mtime))}
+        self.liveBytes = 0
+        self.map = None
+        self.open()
+
+    def open(self):
+        os.makedirs(os.path.dirname(self.dataPath) or '.', exist_ok=True)
+        try:
+            with open(self.dataPath, 'rb') as f:
+                dataHeader = f.read(self.header.size)
+            with open(self.indexPath, 'rb') as f:
+                index = f.read()
+        except FileNotFoundError:
+            dataHeader = index = b''
+        if dataHeader[:8] != self.magic or dataHeader != index[:self.header.size]:
+            self.reset()
+            index = self.header.pack(self.magic, self.packId)
+        self.packId = index[8:self.header.size]
+        self.dataFd = os.open(self.dataPath, os.O_RDWR | O_BINARY)
+        self.dataSize = os.lseek(self.dataFd, 0, os.SEEK_END)
+        self.indexFd = os.open(self.indexPath, os.O_WRONLY | O_BINARY)
+        indexSize = self.load_index(index)
+        # Drop a record torn by a crash, so new records stay aligned
+        os.ftruncate(self.indexFd, indexSize)
+        os.lseek(self.indexFd, 0, os.SEEK_END)
+
+    def reset(self):
+        """ Start a new empty pack """
+
+        self.packId = uuid.uuid4().bytes
+        header = self.header.pack(self.magic, self.packId)
+        for path in (self.dataPath, self.indexPath):
+            with open(path, 'wb') as f:
+                f.write(header)
+
+    def load_index(self, index):
+        """ Replay the index log; Return length of its intact part """
+
+        pos = self.header.size
+        while pos + self.record.size <= len(index):
+            offset, length, size, mtime, keyLength = self.record.unpack_from(index, pos)
+            end = pos + self.record.size + keyLength
+            if end > len(index):
+                break
+            prefix, _, img = index[pos + self.record.size:end].decode('utf-8').partition('_')
+            pos = end
+            old = self.entries.pop((prefix, img), None)
+            if old:
+                self.liveBytes -= old[1]
+            if length and offset + length <= self.dataSize:
+                self.entries[(prefix, img)] = (offset, length, (size, mtime))
+                self.liveBytes += length
+        return pos
+
+    def append_record(self, prefix, img, offset, length, stat):
+        key = f'{ prefix }_{ img }'.encode('utf-8')
+        os.write(self.indexFd, self.record.pack(offset, length, *stat, len(key)) + key)
+
+    def put(self, prefix, img, stat, data):
+        """ Add the thumb of img at source stat (size, mtime), replacing any older one """
+
+        with self.lock:
+            if self.dataFd is None: # closed, eg the folder was switched
+                return
+            # Data before its index record: a crash leaves garbage, not a bad index entry
+            offset = self.dataSize
+            os.lseek(self.dataFd, offset, os.SEEK_SET)
+            os.write(self.dataFd, data)
+            self.dataSize += len(data)
+            self.append_record(prefix, img, offset, len(data), stat)
+            old = self.entries.get((prefix, img))
+            if old:
+                self.liveBytes -= old[1]
+            self.entries[(prefix, img)] = (offset, len(data), tuple(stat))
+            self.liveBytes += len(data)
+
+    def get(self, prefix, img, stat=None):
+        """ Return a copy of the thumb's bytes, or None if missing (or not
+            made from source stat, if given)
+        """
+
+        with self.lock:
+            entry = self.entries.get((prefix, img))
+            if entry is None or (stat is not None and entry[2] != tuple(stat)):
+                return None
+            if self.dataFd is None:
+                return None
+            offset, length, _ = entry
+            if self.map is None or offset + length > len(self.map):
+                self.remap()
+            return self.map[offset:offset + length]
+
+    def has(self, prefix, img, stat):
+        with self.lock:
+            entry = self.entries.get((prefix, img))
+            return entry is not None and entry[2] == tuple(stat)
+
+    def remap(self):
+        if self.map is not None:
+            self.map.close()
+        self.map = mmap.mmap(self.dataFd, self.dataSize, access=mmap.ACCESS_READ)
+
+    def forget(self, img):
+        """ Drop all thumb sizes of img """
+
+        with self.lock:
+            if self.dataFd is None:
+                return
+            for key in [key for key in self.entries if key[1] == img]:
+                self.liveBytes -= self.entries.pop(key)[1]
+                self.append_record(*key, 0, 0, (0, 0))
+
+    @property
+    def garbageBytes(self):
+        return self.dataSize - self.header.size - self.liveBytes
+
+    def compact_if_due(self):
+        garbage = self.garbageBytes
+        if garbage >= self.compactMinBytes and garbage >= self.compactRatio*self.dataSize:
+            self.compact()
+            return True
+        return False
+
+    def compact(self):
+        """ Rewrite the pack with live thumbs only """
+
+        with self.lock:
+            if self.map is None or len(self.map) < self.dataSize:
+                self.remap()
+            self.packId = uuid.uuid4().bytes
+            header = self.header.pack(self.magic, self.packId)
+            entries = {}
+            with open(self.dataPath + '.tmp', 'wb') as data, \
+                    open(self.indexPath + '.tmp', 'wb') as index:
+                data.write(header)
+                index.write(header)
+                offset = self.header.size
+                for (prefix, img), (old, length, stat) in sorted(
+                        self.entries.items(), key=lambda item: item[1][0]):
+                    data.write(self.map[old:old + length])
+                    key = f'{ prefix }_{ img }'.encode('utf-8')
+                    index.write(self.record.pack(offset, length, *stat, len(key)) + key)
+                    entries[(prefix, img)] = (offset, length, stat)
+                    offset += length
+            self.close_files()
+            # Index last: until it is replaced, the old index no longer
+            # matches the new data's pack id, so a crash here resets the pack
+            os.replace(self.dataPath + '.tmp', self.dataPath)
+            os.replace(self.indexPath + '.tmp', self.indexPath)
+            self.entries = entries
+            self.dataFd = os.open(self.dataPath, os.O_RDWR | O_BINARY)
+            self.dataSize = os.lseek(self.dataFd, 0, os.SEEK_END)
+            self.indexFd = os.open(self.indexPath, os.O_WRONLY | O_BINARY)
+            os.lseek(self.indexFd, 0, os.SEEK_END)
+
+    def import_files(self, thumbnailFolder, fresh):
+        """ Move existing thumb files into the pack
+            fresh is {(prefix, img): source stat} of the thumb files to keep;
+            Return number imported
+        """
+
+        imported = 0
+        for (prefix, img), stat in fresh.items():
+            path = os.path.join(thumbnailFolder, f'{ prefix }_{ os.path.splitext(img)[0] }.png')
+            try:
+                with open(path, 'rb') as f:
+                    self.put(prefix, img, stat, f.read())
+            except FileNotFoundError:
+                continue
+            os.remove(path)
+            imported += 1
+        return imported
+
+    def close_files(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        os.close(self.dataFd)
+        os.close(self.indexFd)
+        self.dataFd = self.indexFd = None
+
+    def close(self):
+        with self.lock:
+            if self.dataFd is not None:
+                self.close_files()
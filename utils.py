@@ -1,16 +1,51 @@
 import os
-import glob
+import io
+import errno
 import math
+import time
+import shutil
 import subprocess
 import sys
 from PIL import Image
+from perfstats import perfStats
+from quality import quality_metrics
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
 from multiprocessing import Pool
 
 
-IMG_GLOBS = ('*.jpg', '*.jpeg', '*.png')
-THUMBNAIL_SIZES = {'S': 400}
-THUMBNAIL_LOAD_PATHS = {'S': 'imgs/loading_thumb_400.png'}
+IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png') # matched case-insensitively
+THUMBNAIL_SIZES = {'L': 800, 'M': 600, 'S': 400} # decreasing sizes
+THUMBNAIL_LOAD_PATHS = {
+    'L': 'imgs/loading_thumb_800.png',
+    'M': 'imgs/loading_thumb_600.png',
+    'S': 'imgs/loading_thumb_400.png',
+}
 THUMBNAIL_SIZE_ITEMS = list(THUMBNAIL_SIZES.items())
+THUMBNAIL_MODES = ('1', 'L', 'LA', 'I', 'P', 'RGB', 'RGBA') # PNG-compatible
+THUMBNAIL_COMPRESS_LEVEL = 1 # fast PNG encode; thumbs are a cache
+SCAN_RACY_SECONDS = 2 # don't trust a dir mtime this close to scan time
+COPY_MTIME_WINDOW = 1.0 # seconds; mtimes this close count as equal
+DHASH_SIZE = 8 # DHASH_SIZE**2 bit perceptual hashes
+EXIF_IFD = 0x8769
+EXIF_DATETIME_ORIGINAL = 0x9003
+EXIF_DATETIME = 0x0132
+LARGE_IMAGE_PIXELS = 50_000_000 # above this, images take the large-image path
+MAX_IMAGE_PIXELS = 1 << 30 # Pillow's decompression bomb limit (it fails at twice this)
+RESIZE_STRIP_PIXELS = 4*1024*1024 # output pixels per strip of a large resize
+FICLONE = 0x40049409 # Linux reflink ioctl
+KERNEL_COPY_ERRNOS = {
+    errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EBADF, errno.EPERM,
+    errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOTTY,
+}
+
+_scanCache = {} # {folder: (dirMtime, scanTime, stats)}
+
+# Huge panoramas and scans are expected here; memory is bounded by
+# decode_pixels and the ThumbEngine's pixel budget instead
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
 
 
 def to_grid(arr, numCols):
@@ -28,12 +63,56 @@ def to_grid(arr, numCols):
 
 def list_images(folder):
     """ Return list of image filenames in folder """
-    
-    return [
-        os.path.basename(f) 
-        for g in IMG_GLOBS 
-        for f in glob.glob(os.path.join(folder, g))
-    ]
+
+    return list(image_stats(folder))
+
+def image_stats(folder, refresh=False):
+    """ Return dict {img: (size, mtime)} for image files in folder,
+        in name order, collected in a single directory scan
+        Memoized until the directory mtime changes (or refresh);
+        the returned dict is shared, so don't modify it
+    """
+
+    dirMtime = os.stat(folder).st_mtime_ns
+    cached = _scanCache.get(folder)
+    if (
+        cached and not refresh and cached[0] == dirMtime
+        and cached[1] - dirMtime > SCAN_RACY_SECONDS*1e9
+    ):
+        return cached[2]
+    scanTime = time.time_ns()
+    stats = {}
+    with os.scandir(folder) as entries:
+        for entry in sorted(entries, key=lambda e: e.name):
+            if not is_image_name(entry.name):
+                continue
+            if not entry.is_file():
+                continue
+            st = entry.stat()
+            stats[entry.name] = (st.st_size, st.st_mtime_ns)
+    _scanCache[folder] = (dirMtime, scanTime, stats)
+    return stats
+
+def patch_image_stats(folder, changes):
+    """ Apply {img: (size, mtime) or None if removed} to the memoized scan
+        of folder without rescanning it; Return the patched stats
+    """
+
+    cached = _scanCache.get(folder)
+    if cached is None:
+        return image_stats(folder)
+    stats = dict(cached[2])
+    for img, stat in changes.items():
+        if stat is None:
+            stats.pop(img, None)
+        else:
+            stats[img] = stat
+    stats = dict(sorted(stats.items()))
+    _scanCache[folder] = (os.stat(folder).st_mtime_ns, time.time_ns(), stats)
+    return stats
+
+def is_image_name(name):
+    return os.path.splitext(name)[1].lower() in IMG_EXTENSIONS
 
 def open_image(imagePath):
     """ Display image in default viewer;
@@ -50,33 +129,359 @@ def open_image(imagePath):
         subprocess.run([viewer, imagePath])
 
 def thumbnails(imgDestPair):
-    """ Save PNG thumbnails in decreasing sizes """
+    """ Save PNG thumbnails in decreasing sizes from a single decode,
+        each size cascaded down from the previous one
+        imgDestPair is (image, dest), optionally followed by sizes (to make
+        only some of THUMBNAIL_SIZES), keep (sizes whose bytes to return)
+        and fromThumb (PNG bytes of a larger thumb of the same version of
+        image, to make the sizes from instead of decoding image)
+        If dest is None, no files are written and all sizes' bytes are
+        returned (eg for a ThumbPack)
+        Return (dict {prefix: PNG bytes if prefix in keep else None} of sizes
+        made, image_info of the source plus thumb_info of the smallest thumb;
+        empty if made from a thumb, as the source isn't read)
+    """
+
+    image, dest = imgDestPair[:2]
+    sizes = imgDestPair[2] if len(imgDestPair) > 2 else THUMBNAIL_SIZES
+    keep = imgDestPair[3] if len(imgDestPair) > 3 else ()
+    fromThumb = imgDestPair[4] if len(imgDestPair) > 4 else None
+    if not any(prefix in sizes for prefix in THUMBNAIL_SIZES):
+        return {}, {}
+    with perfStats.timer('thumb.open'):
+        # Decoded by the first im.thumbnail, which drafts JPEGs to the
+        # smallest DCT scale covering that size
+        im = Image.open(io.BytesIO(fromThumb) if fromThumb else image)
+        info = {} if fromThumb else image_info(im)
+    made, thumbInfo = save_thumbnails(im, image, dest, sizes, keep)
+    if not fromThumb:
+        info.update(thumbInfo)
+    return made, info
+
+def save_thumbnails(im, image, dest, sizes=THUMBNAIL_SIZES, keep=()):
+    """ Save PNG thumbnails of opened or decoded im, named after image (see
+        thumbnails); im is shrunk in place
+        Return (thumbs made, thumb_info of the smallest)
+    """
 
-    image, dest = imgDestPair
-    im = Image.open(image)
+    items = [(prefix, size) for prefix, size in THUMBNAIL_SIZE_ITEMS if prefix in sizes]
     name = os.path.basename(image)
     name = os.path.splitext(name)[0] + '.png'
-    for prefix, size in THUMBNAIL_SIZE_ITEMS:
-        im.thumbnail((size, size))
-        im.copy()
-        im.save(os.path.join(dest, f'{ prefix }_{ name }'))
+    made = {}
+    for prefix, size in items:
+        with perfStats.timer('thumb.resize'): # includes the decode, first time
+            im.thumbnail((size, size))
+            if im.mode not in THUMBNAIL_MODES: # after shrinking, so still drafted
+                im = im.convert('RGB')
+        with perfStats.timer('thumb.encode'):
+            buffer = io.BytesIO()
+            im.save(buffer, 'PNG', compress_level=THUMBNAIL_COMPRESS_LEVEL)
+            data = buffer.getvalue()
+        if dest is None:
+            made[prefix] = data
+            continue
+        with perfStats.timer('thumb.write'), \
+                open(os.path.join(dest, f'{ prefix }_{ name }'), 'wb') as f:
+            f.write(data)
+        made[prefix] = data if prefix in keep else None
+    return made, thumb_info([im])[0] if made else {}
+
+def thumb_info(thumbs):
+    """ Return list of dicts {dhash, sharpness, brightness, clipped,
+        contrast} of thumbnail images, with the quality metrics of the
+        batch computed together (see quality.quality_metrics)
+    """
+
+    infos = [{'dhash': dhash(im)} for im in thumbs]
+    with perfStats.timer('thumb.quality'):
+        for info, metrics in zip(infos, quality_metrics(thumbs)):
+            info.update(metrics)
+    return infos
 
-def backup_and_resize(image, dest, backupFolder, percent):
+def dhash(im):
+    """ Return difference hash of im as hex: one bit per pair of adjacent
+        pixels in a tiny grayscale copy, set where brightness increases
+        (near-identical images have hashes a few bits apart)
+    """
+
+    with perfStats.timer('thumb.dhash'):
+        small = im.convert('L').resize((DHASH_SIZE + 1, DHASH_SIZE), Image.BILINEAR)
+        pixels = small.tobytes()
+        bits = 0
+        for row in range(DHASH_SIZE):
+            for col in range(DHASH_SIZE):
+                i = row*(DHASH_SIZE + 1) + col
+                bits = bits << 1 | (pixels[i] < pixels[i + 1])
+    return f'{ bits:0{ DHASH_SIZE**2//4 }x}'
+
+def image_info(im):
+    """ Return dict {width, height, captureTime} of an opened image; only
+        the header is read (captureTime is EXIF 'YYYY:MM:DD HH:MM:SS' or None)
+    """
+
+    width, height = im.size
+    return {'width': width, 'height': height, 'captureTime': capture_time(im)}
+
+def capture_time(im):
+    try:
+        exif = im.getexif()
+        value = exif.get_ifd(EXIF_IFD).get(EXIF_DATETIME_ORIGINAL) or exif.get(EXIF_DATETIME)
+    except Exception: # missing or malformed EXIF
+        return None
+    if isinstance(value, bytes):
+        value = value.decode('ascii', 'replace')
+    value = value.strip('\0 ') if isinstance(value, str) else ''
+    return value[:19] or None
+
+def decode_pixels(image, size=None):
+    """ Return number of pixels decoding image takes, read from its header;
+        for a JPEG with size (width, height) given, at the smallest DCT
+        scale still covering size (see thumbnails)
+        Return 0 if unreadable (the job itself reports the error)
+    """
+
+    try:
+        with Image.open(image) as im:
+            if size:
+                im.draft(None, size) # configures the decoder only
+            return im.size[0]*im.size[1]
+    except Exception:
+        return 0
+
+def thumbnail_cost(imgDestPair):
+    """ Return pixels decoded by the thumbnails job imgDestPair, for a
+        ThumbEngine pixel budget
+    """
+
+    sizes = imgDestPair[2] if len(imgDestPair) > 2 else THUMBNAIL_SIZES
+    largest = max((size for prefix, size in THUMBNAIL_SIZE_ITEMS if prefix in sizes), default=0)
+    if not largest:
+        return 0
+    if len(imgDestPair) > 4 and imgDestPair[4]: # made from a larger thumb
+        return THUMBNAIL_SIZE_ITEMS[0][1]**2
+    return decode_pixels(imgDestPair[0], (largest, largest))
+
+def resize_cost(args):
+    """ Return pixels held at once by the resize_and_thumbnail job args
+        (decoded source, resize intermediate and output), for a ThumbEngine
+        pixel budget
+    """
+
+    image, percent = args[:2]
+    try:
+        with Image.open(image) as im:
+            pixels = im.size[0]*im.size[1]
+            width, height = resized_size(im.size, percent)
+            if pixels <= LARGE_IMAGE_PIXELS:
+                return int(pixels*(1 + percent/100.0)) + width*height
+            im.draft(None, (width, height)) # reduced decode, resized in strips
+            return im.size[0]*im.size[1] + width*height + RESIZE_STRIP_PIXELS
+    except Exception:
+        return 0
+
+def preview_image(imageSizePair):
+    """ Pool job: Return PNG bytes of image shrunk to fit size (width, height)
+        from one reduced decode, for the in-app preview
+        imageSizePair is (image, size)
+    """
+
+    image, size = imageSizePair
+    with perfStats.timer('preview.decode'):
+        im = Image.open(image)
+        im.draft(None, size)
+        im.load()
+    if im.mode not in THUMBNAIL_MODES:
+        im = im.convert('RGB')
+    with perfStats.timer('preview.resize'):
+        im.thumbnail(size)
+    with perfStats.timer('preview.encode'):
+        buffer = io.BytesIO()
+        im.save(buffer, 'PNG', compress_level=THUMBNAIL_COMPRESS_LEVEL)
+    return buffer.getvalue()
+
+def preview_cost(imageSizePair):
+    """ Return pixels decoded by the preview_image job imageSizePair """
+
+    return decode_pixels(*imageSizePair)
+
+def read_image_info(imageThumbPairs):
+    """ Pool job: Return list of image_info of each image plus thumb_info
+        of its existing thumbnail, without decoding the images themselves
+        (None for an image or thumb that can't be read)
+        imageThumbPairs is a batch of (image, thumb path or bytes)
+    """
+
+    infos = []
+    thumbs = []
+    for image, thumb in imageThumbPairs:
+        try:
+            with Image.open(image) as im:
+                info = image_info(im)
+            im = Image.open(io.BytesIO(thumb) if isinstance(thumb, bytes) else thumb)
+            im.load()
+        except Exception:
+            infos.append(None)
+            continue
+        infos.append(info)
+        thumbs.append(im)
+    for info, thumbInfo in zip([info for info in infos if info], thumb_info(thumbs)):
+        info.update(thumbInfo)
+    return infos
+
+def batches(items, size):
+    """ Yield lists of up to size consecutive items """
+
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def resize_file(image, dest, percent):
     """ Overwrite image with copy resized by given percent out of 100
         (eg 100px, percent = 90 -> 90px)
-        and save backup copy
+        (The caller backs image up first; see FolderData.backup_image)
+        Return the resized image
     """
 
-    im = Image.open(image)
     name = os.path.basename(image)
-    im.save(os.path.join(backupFolder, name))
+    with perfStats.timer('resize.decode'):
+        im = Image.open(image)
+        newSize = resized_size(im.size, percent)
+        large = im.size[0]*im.size[1] > LARGE_IMAGE_PIXELS
+        if large:
+            perfStats.incr('resize.large')
+            # JPEG: decode at the smallest DCT scale still covering newSize
+            im.draft(None, newSize)
+        im.load()
+    with perfStats.timer('resize.resize'):
+        resized = resize_in_strips(im, newSize) if large else im.resize(newSize)
+    # Write a new file and swap it in, so a hardlinked backup keeps the original
+    destPath = os.path.join(dest, name)
+    tmpPath = os.path.join(dest, f'.{ name }.resize.tmp')
+    with perfStats.timer('resize.encode'):
+        # Keep EXIF (eg capture time) with the resized image
+        extra = {'exif': im.info['exif']} if 'exif' in im.info else {}
+        resized.save(tmpPath, format=im.format, **extra)
+        os.replace(tmpPath, destPath)
+    return resized
+
+def resized_size(size, percent):
     k = percent/100.0
-    newSize = (round(k*im.size[0]), round(k*im.size[1]))
-    im.resize(newSize).save(os.path.join(dest, name))
+    return (max(1, round(k*size[0])), max(1, round(k*size[1])))
+
+def resize_in_strips(im, size, resample=Image.BICUBIC):
+    """ Return im resized to size, a strip of output rows at a time
+        Pillow resizes in two passes, and done whole the first pass
+        makes an intermediate as tall as im; per strip it is only as tall
+        as the source rows under that strip. Each strip reads the source
+        rows around its box too, so the strips join seamlessly
+    """
+
+    width, height = size
+    if im.mode in ('1', 'P') or width*height <= RESIZE_STRIP_PIXELS:
+        return im.resize(size, resample)
+    out = Image.new(im.mode, size)
+    rows = max(1, RESIZE_STRIP_PIXELS//width)
+    scale = im.size[1]/height
+    for top in range(0, height, rows):
+        bottom = min(height, top + rows)
+        strip = im.resize(
+            (width, bottom - top), resample, box=(0, top*scale, im.size[0], bottom*scale)
+        )
+        out.paste(strip, (0, top))
+    return out
+
+def resize_and_thumbnail(args):
+    """ Pool job: resize and re-thumbnail one image with one decode
+        args is (image, percent, thumbDest, sizes, keep)
+        Return ((size, mtime) of resized image, thumbnails made, image info)
+        (see thumbnails and resize_file)
+    """
+
+    image, percent, thumbDest, sizes, keep = args
+    resized = resize_file(image, os.path.dirname(image), percent)
+    info = image_info(resized)
+    made, thumbInfo = save_thumbnails(resized, image, thumbDest, sizes, keep)
+    info.update(thumbInfo)
+    st = os.stat(image)
+    return (st.st_size, st.st_mtime_ns), made, info
+
+
+def copy_image_file(src, destFolder):
+    """ Copy src into destFolder with metadata (like shutil.copy2),
+        skipping it if an identical (size, mtime) file is already there
+        Return 'skipped' or 'copied'
+    """
+
+    dst = os.path.join(destFolder, os.path.basename(src))
+    srcStat = os.stat(src)
+    try:
+        dstStat = os.stat(dst)
+    except FileNotFoundError:
+        pass
+    else:
+        if (
+            dstStat.st_size == srcStat.st_size
+            and abs(dstStat.st_mtime - srcStat.st_mtime) <= COPY_MTIME_WINDOW
+        ):
+            perfStats.incr('copy.skipped')
+            return 'skipped'
+    tmpPath = os.path.join(destFolder, f'.{ os.path.basename(src) }.copy.tmp')
+    with open(src, 'rb') as fsrc, open(tmpPath, 'wb') as fdst:
+        if not kernel_copy(fsrc.fileno(), fdst.fileno(), srcStat.st_size):
+            fdst.seek(0)
+            fdst.truncate()
+            shutil.copyfileobj(fsrc, fdst, 1024*1024)
+    shutil.copystat(src, tmpPath)
+    os.replace(tmpPath, dst)
+    perfStats.incr('copy.copied')
+    perfStats.incr('copy.bytes', srcStat.st_size)
+    return 'copied'
+
+def kernel_copy(srcFd, dstFd, size):
+    """ Copy size bytes between file descriptors without passing them
+        through userspace: reflink where the filesystem supports it,
+        else copy_file_range, else sendfile
+        Return False if no kernel copy method is available
+    """
 
+    if fcntl is not None:
+        try:
+            fcntl.ioctl(dstFd, FICLONE, srcFd)
+            return True
+        except OSError:
+            pass
+    copiers = []
+    if hasattr(os, 'copy_file_range'):
+        copiers.append(lambda offset: os.copy_file_range(
+            srcFd, dstFd, size - offset, offset, offset
+        ))
+    if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+        copiers.append(lambda offset: os.sendfile(dstFd, srcFd, offset, size - offset))
+    for copier in copiers:
+        offset = 0
+        try:
+            while offset < size:
+                sent = copier(offset)
+                if sent == 0:
+                    break
+                offset += sent
+        except OSError as e:
+            if e.errno not in KERNEL_COPY_ERRNOS:
+                raise
+            os.lseek(dstFd, 0, os.SEEK_SET)
+            continue
+        if offset == size:
+            return True
+    return False
 
-def make_thumbnails(src, dest, makeDest=True):
+def make_thumbnails(src, dest, makeDest=True, numWorkers=None):
     """ Make thumbnails from src images in the dest folder 
+        (numWorkers processes; default depends on number of images)
         Return number of images processed
     """
 
@@ -84,13 +489,14 @@ def make_thumbnails(src, dest, makeDest=True):
         os.makedirs(dest)
     images = [os.path.join(src, img) for img in list_images(src)]
     L = len(images)
-    if L < 8:
+    if numWorkers is None:
+        numWorkers = 1 if L < 8 else 4 if L < 64 else 8
+    if numWorkers <= 1:
         for img in images:
             thumbnails((img, dest))
     else:
-        numThreads = 4 if L < 64 else 8
-        pool = Pool(numThreads)
-        pool.map(thumbnails, [(img, dest) for img in images])
+        with Pool(numWorkers) as pool:
+            pool.map(thumbnails, [(img, dest) for img in images])
     return L
 
 def image_size(filepath):
@@ -0,0 +1,182 @@
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+from utils import image_stats, patch_image_stats, is_image_name
+
+
+ADDED = 'added'
+REMOVED = 'removed'
+MODIFIED = 'modified'
+
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+class Inotify():
+    """ Minimal inotify reader for one directory (Linux only) """
+
+    mask = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    @classmethod
+    def create(cls, folder):
+        """ Return Inotify watching folder, or None if unavailable """
+
+        if not sys.platform.startswith('linux'):
+            return None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                return None
+            if libc.inotify_add_watch(fd, os.fsencode(folder), cls.mask) < 0:
+                os.close(fd)
+                return None
+        except (OSError, AttributeError):
+            return None
+        return cls(fd)
+
+    def read(self, timeout):
+        """ Wait up to timeout seconds for events;
+            Return (set of changed names, True if the kernel queue overflowed)
+        """
+
+        names = set()
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return names, False
+        try:
+            data = os.read(self.fd, 64*1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return names, False
+            raise
+        overflow = False
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            _, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+            elif name:
+                names.add(os.fsdecode(name))
+        return names, overflow
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FolderWatcher(threading.Thread):
+    """ Watch an image folder and report added, removed and modified images
+        by calling onChange(kind, img) from the watcher thread
+
+        Uses inotify where available (only changed files are stat'ed),
+        otherwise polls with a fresh directory scan every pollInterval
+    """
+
+    pollInterval = 2.0
+    settleTime = 0.25 # wait for a burst of events to go quiet...
+    maxSettleTime = 1.0 # ...but not longer than this
+
+    def __init__(self, folder, onChange, usePolling=False):
+        super().__init__(daemon=True)
+        self._stop_event = threading.Event()
+        self.folder = folder
+        self.onChange = onChange
+        self.known = dict(image_stats(folder))
+        self.inotify = None if usePolling else Inotify.create(folder)
+
+    def run(self):
+        try:
+            if self.inotify:
+                self.run_inotify()
+            else:
+                self.run_polling()
+        finally:
+            if self.inotify:
+                self.inotify.close()
+
+    def run_polling(self):
+        while not self._stop_event.wait(self.pollInterval):
+            try:
+                self.apply_scan(image_stats(self.folder, refresh=True))
+            except FileNotFoundError:
+                continue
+
+    def run_inotify(self):
+        while not self._stop_event.is_set():
+            names, overflow = self.inotify.read(timeout=0.5)
+            if not names and not overflow:
+                continue
+            settleStart = time.monotonic()
+            while time.monotonic() - settleStart < self.maxSettleTime:
+                moreNames, moreOverflow = self.inotify.read(timeout=self.settleTime)
+                if not moreNames and not moreOverflow:
+                    break
+                names |= moreNames
+                overflow = overflow or moreOverflow
+            if overflow:
+                self.apply_scan(image_stats(self.folder, refresh=True))
+            else:
+                self.apply_names(names)
+
+    def apply_names(self, names):
+        """ Stat only the named files and report what changed """
+
+        changes = {}
+        for img in names:
+            if not is_image_name(img):
+                continue
+            try:
+                st = os.stat(os.path.join(self.folder, img))
+            except FileNotFoundError:
+                changes[img] = None
+            else:
+                changes[img] = (st.st_size, st.st_mtime_ns)
+        if changes:
+            patch_image_stats(self.folder, changes)
+            self.apply_changes(changes)
+
+    def apply_scan(self, stats):
+        """ Report differences between a full scan and what is known """
+
+        changes = {img: None for img in self.known.keys() - stats.keys()}
+        changes.update({
+            img: stat for img, stat in stats.items()
+            if self.known.get(img) != stat
+        })
+        self.apply_changes(changes)
+
+    def apply_changes(self, changes):
+        for img, stat in changes.items():
+            old = self.known.get(img)
+            if stat is None:
+                if old is not None:
+                    del self.known[img]
+                    self.onChange(REMOVED, img)
+            elif old is None:
+                self.known[img] = stat
+                self.onChange(ADDED, img)
+            elif old != stat:
+                self.known[img] = stat
+                self.onChange(MODIFIED, img)
+
+    def stop(self):
+        self._stop_event.set()